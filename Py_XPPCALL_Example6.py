@@ -0,0 +1,27 @@
+"""
+NumPy backend: integrate hh.ode in python, without xppaut, for many input currents at once
+"""
+
+# import some modules including Py_XPPCALL
+import matplotlib.pylab as plt
+import numpy as np
+from xppcall import xpprun, xpprun_batch
+from xppcall_numpy import load_numpy_model
+
+# same output as xpprun with xppaut
+npa, vn = xpprun('hh.ode', parameters={'i':20.0}, backend='numpy')
+plt.figure()
+plt.plot(npa[:,0], npa[:, 1+vn.index('v')])
+
+# all runs of a batch are integrated at once as one array of states
+runs = [{'parameters':{'i':i}} for i in np.linspace(0, 20, 5)]
+plt.figure()
+for npa, vn in xpprun_batch('hh.ode', runs, backend='numpy'):
+    plt.plot(npa[:,0], npa[:, 1+vn.index('v')])
+
+# or directly, out has the shape (number of runs, number of time points, 1+number of variables)
+nm = load_numpy_model('hh.ode')
+out = nm.integrate(parameters={'i':np.linspace(0, 20, 1000)})
+print(out.shape)
+
+plt.show()
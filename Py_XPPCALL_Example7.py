@@ -0,0 +1,29 @@
+"""
+Fitting hh.ode with a population-based optimizer: every generation of differential_evolution
+is run as one parallel batch of xppaut processes (compare with the serial fmin of Py_XPPCALL_Example.py)
+"""
+
+# import some modules including Py_XPPCALL
+import matplotlib.pylab as plt
+import numpy as np
+from scipy.optimize import differential_evolution
+from xppcall import xpprun
+from xppcall_optimize import PopulationObjective, SquaredError
+
+# define desired V graph
+npa, vn = xpprun('hh.ode', clean_after=True)
+target_v = -80.0+20*npa[:,0]*(np.sign(-npa[:,0]+4)+1)
+
+# runs that fail or take longer than 10 s get the penalty instead of blocking the fit
+objective = PopulationObjective('hh.ode', ['i'], SquaredError('v', target_v), penalty=1e10, clean_after=True, timeout=10)
+
+if __name__ == '__main__':
+    res = differential_evolution(objective, [(0, 40)], vectorized=True, updating='deferred', popsize=20, maxiter=20)
+    print(res.x, res.fun, 'runs %d, cached %d, failed %d' % (objective.runs, objective.cached, objective.failed))
+
+    npa, vn = xpprun('hh.ode', parameters={'i':res.x[0]}, clean_after=True)
+    plt.figure()
+    plt.plot(npa[:,0], npa[:, 1+vn.index('v')], label='fit')
+    plt.plot(npa[:,0], target_v, label='target')
+    plt.legend()
+    plt.show()
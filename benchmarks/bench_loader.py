@@ -0,0 +1,59 @@
+"""
+Benchmark of the loader of xpp output files: load_output vs np.genfromtxt.
+
+The output file is synthetic, it has the shape of a wc.ode-sized network model:
+time + 202 variables, written the way xpp writes output.dat.
+
+python benchmarks/bench_loader.py [rows] [columns] [repeats]
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from xppcall import load_output
+
+
+def write_fake_output(filepath, rows, cols, seed=0):
+    """
+    writes rows x cols numbers formatted as xpp does: '%.8g ' per number, a trailing space and a newline per row
+    """
+    rng = np.random.RandomState(seed)
+    data = rng.standard_normal((rows, cols))
+    data[:, 0] = np.arange(rows)*0.05
+    with open(filepath, 'w') as f:
+        for row in data:
+            f.write(' '.join('%.8g' % x for x in row)+' \n')
+
+
+def main(rows=2000, cols=203, repeats=5):
+    fd, filepath = tempfile.mkstemp(suffix='.dat')
+    os.close(fd)
+    try:
+        write_fake_output(filepath, rows, cols)
+        size = os.path.getsize(filepath)
+
+        ref = np.genfromtxt(filepath, delimiter=' ')
+        assert np.array_equal(ref, load_output(filepath))
+
+        loaders = [('np.genfromtxt', lambda: np.genfromtxt(filepath, delimiter=' ')),
+                   ('load_output', lambda: load_output(filepath)),
+                   ('load_output float32', lambda: load_output(filepath, dtype=np.float32))]
+
+        print('%d rows x %d columns, %.1f MB' % (rows, cols, size/1e6))
+        base = None
+        for name, loader in loaders:
+            t = min(timeit.repeat(loader, number=1, repeat=repeats))
+            if base is None:
+                base = t
+            print('%-22s %8.4f s  %6.1f MB/s  x%.1f' % (name, t, size/1e6/t, base/t))
+    finally:
+        os.remove(filepath)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+A deterministic stand-in for xppaut, so that benchmarks run on machines without XPPAUT.
+
+fake_xppaut.py model.ode -silent [-with 'a=1;b=2'] [-icfile inits.ic] [-runnow] -outfile output.dat
+
+It writes an output file the way xpp does: one row per time point '%.8g ' formatted,
+time and then all variables of the model. The number of rows follows the numerical options
+of the file (total, dt, njmp, t0, trans) and those given with -with. The values are smooth functions
+of time, the parameters and the initial conditions, the model is not integrated.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from xppcall import load_model
+
+
+def main(argv):
+    odefile = None; outfile = 'output.dat'; withstr = ''; icfile = None
+    i = 0
+    while i < len(argv):
+        a = argv[i]
+        if a in ('-outfile', '-with', '-icfile'):
+            val = argv[i+1]
+            i += 1
+            if a == '-outfile':
+                outfile = val
+            elif a == '-with':
+                withstr = val
+            else:
+                icfile = val
+        elif not a.startswith('-'):
+            odefile = a
+        i += 1
+    if odefile is None:
+        sys.stderr.write('usage: fake_xppaut.py model.ode -silent -outfile output.dat\n')
+        return 1
+
+    model = load_model(odefile)
+    numerics = {'total': 20., 'dt': .05, 'njmp': 1., 't0': 0., 'trans': 0.}
+    numerics.update((k, float(v)) for k, v in model.numerics.items() if k in numerics)
+    pars = dict((k, float(v)) for k, v in model.pars.items())
+    for item in withstr.split(';'):
+        if '=' in item:
+            k, v = item.split('=', 1)
+            k = k.strip().lower()
+            if k in numerics:
+                numerics[k] = float(v)
+            elif k in ('meth', 'nout'):
+                pass
+            else:
+                pars[k] = float(v)
+
+    if icfile is not None:
+        y0 = np.loadtxt(icfile, ndmin=1)
+    else:
+        y0 = np.array([float(v) for v in model.initial_state()])
+
+    nsteps = int(round(numerics['total']/numerics['dt']))
+    t = numerics['t0']+numerics['dt']*np.arange(0, nsteps+1, max(1, int(numerics['njmp'])))
+    t = t[t >= numerics['trans']]
+    nvars = len(model.variables)
+    y0 = np.concatenate([y0, np.zeros(nvars-len(y0))])[:nvars]
+    freq = 1.+(sum(pars.values()) % 1.)+.1*np.arange(nvars)
+    out = np.empty((len(t), 1+nvars))
+    out[:, 0] = t
+    out[:, 1:] = y0*np.cos(np.outer(t, freq))+np.sin(np.outer(t, freq))
+
+    np.savetxt(outfile, out, fmt='%.8g', delimiter=' ', newline=' \n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,114 @@
+"""
+Benchmarks of Py_XPPCALL: parsing of .ode files, rewriting them, loading the output
+and the whole xpprun on the bundled models. xppaut is replaced by fake_xppaut.py,
+so the numbers show the overhead of the wrapper, not the speed of the solver.
+
+python benchmarks/run_benchmarks.py [--output results.json] [--repeat 5] [--xppname xppaut]
+
+The results are printed and written to a JSON file to compare releases.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.join(here, '..')
+sys.path.insert(0, root)
+sys.path.insert(0, here)
+
+import xppcall
+from bench_loader import write_fake_output
+
+models = ['hh.ode', 'simple.ode', 'simple2.ode', 'simple_partial_inits.ode', 'schnakenberg.ode', 'wc.ode']
+model_inits = {'hh.ode': {'v':-60}, 'simple.ode': {'u':-.1, 'v':-.2}, 'simple2.ode': {'u':-.1, 'v':-.2},
+               'simple_partial_inits.ode': {'u':-.1, 'v':-.2}, 'schnakenberg.ode': {'u0':1.4},
+               'wc.ode': {'u':[.1, .2, .3, .4, .5]}}
+model_pars = {'hh.ode': {'i':10.}, 'simple.ode': {'q':2.}, 'simple2.ode': {'q':2.},
+              'simple_partial_inits.ode': {'q':2.}, 'schnakenberg.ode': {'a':1.1}, 'wc.ode': {'tau':2.}}
+
+
+def bench(results, name, func, repeat, number=None):
+    """
+    times func, stores the best and the mean time per call in results[name]
+    """
+    if number is None:
+        # calibrate to about 0.1 s per repeat
+        number = 1
+        while number < 10**6:
+            t = timeit.timeit(func, number=number)
+            if t > .1:
+                break
+            number *= 10
+    times = [t/number for t in timeit.repeat(func, number=number, repeat=repeat)]
+    results[name] = {'best': min(times), 'mean': sum(times)/len(times), 'number': number, 'repeat': repeat}
+    print('%-55s %12.3f us' % (name, 1e6*min(times)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', default='benchmarks.json', help='JSON file with results')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--xppname', default=None, help='real xppaut to benchmark instead of fake_xppaut.py')
+    args = parser.parse_args(argv)
+
+    xppname = args.xppname or [sys.executable, os.path.join(here, 'fake_xppaut.py')]
+    workdir = tempfile.mkdtemp(prefix='xppcall_bench_')
+    results = {}
+    try:
+        for m in models:
+            filepath = os.path.join(root, m)
+            srclines = xppcall.file_to_lines(filepath)
+            bench(results, 'search_state_vars_in_srclines[%s]' % m, lambda: xppcall.search_state_vars_in_srclines(srclines), args.repeat)
+            bench(results, 'read_init_values[%s]' % m, lambda: xppcall.read_init_values(srclines), args.repeat)
+            bench(results, 'OdeModel[%s]' % m, lambda: xppcall.OdeModel(srclines), args.repeat)
+            newfilepath = os.path.join(workdir, m)
+            inits = model_inits[m]
+            bench(results, 'change_inits_in_ode_and_save[%s]' % m,
+                  lambda: xppcall.change_inits_in_ode_and_save(list(srclines), dict(inits), newfilepath), args.repeat)
+            bench(results, 'OdeTemplate[%s]' % m, lambda: xppcall.OdeTemplate(srclines), args.repeat)
+            template = xppcall.OdeTemplate(srclines)
+            bench(results, 'OdeTemplate.render[%s]' % m, lambda: template.render(inits=inits), args.repeat)
+
+        for rows, cols in ((401, 5), (2001, 203)):
+            outfile = os.path.join(workdir, 'output_%dx%d.dat' % (rows, cols))
+            write_fake_output(outfile, rows, cols)
+            bench(results, 'load_output[%dx%d]' % (rows, cols), lambda: xppcall.load_output(outfile), args.repeat)
+            bench(results, 'load_output_tail[%dx%d]' % (rows, cols), lambda: xppcall.load_output_tail(outfile, 1), args.repeat)
+            bench(results, 'np.genfromtxt[%dx%d]' % (rows, cols), lambda: np.genfromtxt(outfile, delimiter=' '), args.repeat)
+
+        for m in models:
+            filepath = os.path.join(workdir, m)
+            shutil.copy(os.path.join(root, m), filepath)
+            kw = dict(xppname=xppname, clean_after=True)
+            bench(results, 'xpprun[%s]' % m, lambda: xppcall.xpprun(filepath, **kw), args.repeat, number=3)
+            bench(results, 'xpprun parameters+inits[%s]' % m,
+                  lambda: xppcall.xpprun(filepath, parameters=model_pars[m], inits=model_inits[m], **kw), args.repeat, number=3)
+            st = xppcall.RunStats()
+            for i in range(3):
+                xppcall.xpprun(filepath, stats=st, **kw)
+            results['xpprun phases[%s]' % m] = st.as_dict()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'date': datetime.datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'xppname': xppname,
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print('results are written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+OdeTemplate rewrites .ode files as the old change_parameters_in_ode_and_save and
+change_inits_in_ode_and_save (regular expressions over the lines) did, on every bundled model.
+
+python -m pytest tests
+
+For every model, parameters and inits are changed one by one and all together: every parameter,
+every scalar init, every array init (a list of values), state variables without inits, and an unknown name.
+The old and the new file are compared as text, and if the text differs, by the values xpp would read:
+the parameters and the initial conditions of all state variables parsed by OdeModel.
+"""
+
+import glob
+import os
+import re
+import sys
+
+import numpy as np
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.join(here, '..')
+sys.path.insert(0, root)
+
+import xppcall
+from xppcall import OdeModel, OdeTemplate, init_re_sc1, init_re_sc2, init_re_ar1, init_re_ar2, search_state_vars_in_srclines
+
+
+def old_change_parameters(srclines, parameters):
+    """
+    the rewrite of parameters before OdeTemplate, returns the new content
+    """
+    lparameters = {pn.lower():(lambda x: repr(x) if not isinstance(x,str) else x)(pv) for pn,pv in parameters.items()}
+    pnames = lparameters.keys()
+    def repl_in_par(matchobj):
+        mog = matchobj.group(1).lower()
+        if mog in pnames:
+           return matchobj.group(1)+matchobj.group(2)+lparameters[mog]
+        else:
+           return matchobj.group(0)
+
+    i_par_lines = np.nonzero([re.search(r'^ *(parameters|par|param|params|p) (.+)$', line, flags=re.IGNORECASE) is not None for line in srclines])[0]
+    nsrclines=srclines[:]
+    for i in i_par_lines:
+        nsrclines[i] = re.sub(r'([a-z0-9_]+)( *= *)([0-9\.e\-\+]+)', repl_in_par, nsrclines[i], flags=re.IGNORECASE)
+    return ''.join(nsrclines)
+
+
+def old_change_inits(srclines, inits):
+    """
+    the rewrite of inits before OdeTemplate, returns the new content
+    """
+    srclines = list(srclines); inits = dict(inits)
+    linits = {pn.lower():(lambda x: repr(x) if not isinstance(x,str) else x)(pv) for pn,pv in inits.items()}
+    pnames = linits.keys()
+
+    def repl_in_par(matchobj):
+        mog = matchobj.group(1).lower()
+        if matchobj.group(2) != None:
+            if mog in pnames:
+                out = matchobj.group(1)+matchobj.group(2)+matchobj.group(3)+linits[mog]
+            else:
+                out = matchobj.group(0)
+        else:
+            if mog in pnames:
+                out = matchobj.group(1)+matchobj.group(3)+linits[mog]
+            else:
+                out = matchobj.group(0)
+        return out.replace(" ","")
+
+    def repl_in_ar(matchobj):
+        mog = matchobj.group(1).lower()
+        idx = matchobj.group(2).split('..')
+        idxrange = np.arange(int(idx[0]),int(idx[-1])+1,1)
+        if mog not in pnames:
+            return matchobj.group(0)
+        listval = linits[mog][1:-1].split(',')
+        inits_new = ''
+        if matchobj.group(3) != None:
+            if len(listval) != len(idxrange):
+                raise ValueError('make sure ode array numbers coincide with the number of initial conditions')
+            for i in range(len(idxrange)):
+                inits_new += matchobj.group(1)+str(idxrange[i])+matchobj.group(3)+'='+listval[i]+'\n'
+        else:
+            for i in range(len(idxrange)):
+                inits_new += matchobj.group(1)+str(idxrange[i])+'='+listval[i]+','
+        return inits_new[:-1].replace(" ","")
+
+    i_par_lines = np.nonzero([re.search(init_re_sc1+'|'+init_re_sc2,line,flags=re.IGNORECASE) is not None for line in srclines])[0]
+    i_ar_lines = np.nonzero([re.search(init_re_ar1+'|'+init_re_ar2,line,flags=re.IGNORECASE) is not None for line in srclines])[0]
+    i_d_line = np.nonzero([re.search(r'^ *(d)|^ *(done)',line,flags=re.IGNORECASE) is not None for line in srclines])[0]
+    i_d_line = -1 if i_d_line.size == 0 else i_d_line[0]
+
+    dnelist = 'init '
+    delete_keys = []
+    combinedlist = ''
+    for i in range(len(i_par_lines)):
+        combinedlist += srclines[i_par_lines[i]]
+    for k in inits:
+        if not(k in combinedlist):
+            vn = search_state_vars_in_srclines(srclines)
+            if k in vn:
+                dnelist += k+'='+str(inits[k])
+            else:
+                delete_keys.append(k)
+    for key in delete_keys:
+        del inits[key]
+    if dnelist != 'init ':
+        srclines[i_d_line] = ''
+        dnelist += '\n'
+        srclines.append(dnelist)
+        srclines.append('d')
+
+    nsrclines=srclines[:]
+    for i in i_par_lines:
+        nsrclines[i] = re.sub(r'([a-z0-9_]+)( *\( *0 *\) *)?( *= *)([0-9\.e\-\+]+)', repl_in_par, nsrclines[i], flags=re.IGNORECASE)
+    for i in i_ar_lines:
+        nsrclines[i] = re.sub(r'([a-z0-9_]+)\[([0-9]+..[0-9]+)\]( *\( *0 *\) *)?( *= *)([0-9\.e\-\+]+)', repl_in_ar, nsrclines[i], flags=re.IGNORECASE)
+    return ''.join(nsrclines)
+
+
+def values(content):
+    """
+    the parameters and the initial conditions of all state variables of an ODE file, as xpp reads them
+    """
+    model = OdeModel(content.splitlines(True))
+    pars = {k:float(v) for k, v in model.pars.items()}
+    inits = {k:float(v) for k, v in model.state_inits.items()}
+    return pars, inits
+
+
+def cases(model):
+    """
+    the list of (description, parameters, inits) to check on a model
+    """
+    new = lambda k, v: round(float(v)*1.5+.25, 6)
+    out = [('par %s' % k, {k:new(k, v)}, None) for k, v in sorted(model.pars.items())]
+    if model.pars:
+        out.append(('all pars', {k:new(k, v) for k, v in model.pars.items()}, None))
+    elements = set(a+str(j) for a, (lo, hi) in model.init_arrays.items() for j in range(lo, hi+1))
+    scalar = dict((k, v) for k, v in model.state_inits.items() if k not in elements)
+    out += [('init %s' % k, None, {k:new(k, v)}) for k, v in sorted(scalar.items())]
+    out += [('init %s[%d..%d]' % (k, lo, hi), None, {k:[.1*(j+1) for j in range(hi-lo+1)]}) for k, (lo, hi) in sorted(model.init_arrays.items())]
+    undeclared = [v for v in model.state_vars if v not in model.state_inits]
+    out += [('init %s (not in the file)' % k, None, {k:-.5}) for k in undeclared[:3]]
+    out.append(('unknown name', None, {'nosuchvar':1.}))
+    if scalar:
+        out.append(('all scalar inits and pars', {k:new(k, v) for k, v in model.pars.items()}, {k:new(k, v) for k, v in scalar.items()}))
+    return out
+
+
+def rewrites():
+    """
+    the cases of all bundled models, as parameters of test_rewrite
+    """
+    out = []
+    for filepath in sorted(glob.glob(os.path.join(root, '*.ode'))):
+        for name, parameters, inits in cases(OdeModel(xppcall.file_to_lines(filepath))):
+            out.append(pytest.param(filepath, name, parameters, inits, id='%s: %s' % (os.path.basename(filepath), name)))
+    return out
+
+
+@pytest.mark.parametrize('filepath, name, parameters, inits', rewrites())
+def test_rewrite(filepath, name, parameters, inits):
+    srclines = xppcall.file_to_lines(filepath)
+    old = ''.join(srclines)
+    if parameters is not None:
+        old = old_change_parameters(old.splitlines(True), parameters)
+    if inits is not None:
+        old = old_change_inits(old.splitlines(True), inits)
+    new = OdeTemplate(srclines).render(parameters=parameters, inits=inits)
+    # the same text up to spaces, or the same values read by xpp
+    if old.replace(' ', '') != new.replace(' ', ''):
+        assert values(old) == values(new), name
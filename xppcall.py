@@ -18,11 +18,21 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <http://www.gnu.org/licenses/>
 
+import io
 import os
+import json
+import hashlib
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import numpy as np
 import re
-from random import random
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 
 # initial condition regex. The syntax differs depending on scalar or array.
@@ -31,18 +41,99 @@ from random import random
 
 # scalar inits
 init_re_sc1 = '^ *(init) (.+)$'
-init_re_sc2 = '^ *(.+ *\( *0 *\) *.+)$'
-init_re_ar1 = '^ *(init) (.+ *\[[0-9]+\.\.[0-9]+\] *.+)$'
+init_re_sc2 = r'^ *(.+ *\( *0 *\) *.+)$'
+init_re_ar1 = r'^ *(init) (.+ *\[[0-9]+\.\.[0-9]+\] *.+)$'
 #init_re_ar1b = '^ *(init) (.+ *\[[0-9]+\.\.[0-9]+\] *.+)$'
-init_re_ar2 = '^ *(.+ *\[[0-9]+\.\.[0-9]+\] *\( *0 *\) *.+)$'
+init_re_ar2 = r'^ *(.+ *\[[0-9]+\.\.[0-9]+\] *\( *0 *\) *.+)$'
 
 # array inits coming soon...
 
+# compiled once, the patterns are shared by the read_* functions and OdeModel
+state_var_sc_re = re.compile('^ *d([a-zA-Z0-9_]+)/dt[ \t]*=|^ *([a-zA-Z0-9_]+)\'[ \t]*=|^ *aux +([a-zA-Z0-9_]+) *=', flags=re.IGNORECASE)
+state_var_ar_re = re.compile(r'^ *([a-zA-Z0-9_]+)(\[[0-9]+\.\.[0-9]+\])\'[ \t]*=|^ *aux +([a-zA-Z0-9_]+)(\[[0-9]+\.\.[0-9]+\]) *=', flags=re.IGNORECASE)
+par_line_re = re.compile('^ *(parameters|par|param|params|p) (.+)$', flags=re.IGNORECASE)
+num_line_re = re.compile('^ *(@) (.+)$', flags=re.IGNORECASE)
+init_line_re = re.compile(init_re_sc1+'|'+init_re_sc2+'|'+init_re_ar1+'|'+init_re_ar2, flags=re.IGNORECASE)
+init_sc_line_re = re.compile(init_re_sc1+'|'+init_re_sc2, flags=re.IGNORECASE)
+init_ar_line_re = re.compile(init_re_ar1+'|'+init_re_ar2, flags=re.IGNORECASE)
+done_line_re = re.compile('^ *(d|done) *$', flags=re.IGNORECASE)
+# %[1..3] ... % blocks of xpp, their state variables are not found by search_state_vars_in_srclines
+block_line_re = re.compile('^ *%')
+value_re = re.compile(r'([a-z0-9_]+) *= *([0-9\.e\-\+]+)', flags=re.IGNORECASE)
+# values rewritten by OdeTemplate: parameters, scalar inits v=*, v(0)=*, array inits v[0..2]=*, v[0..2](0)=*
+par_value_re = re.compile(r'([a-z0-9_]+)( *= *)([0-9\.e\-\+]+)', flags=re.IGNORECASE)
+init_value_sc_re = re.compile(r'([a-z0-9_]+)( *\( *0 *\) *)?( *= *)([0-9\.e\-\+]+)', flags=re.IGNORECASE)
+init_value_ar_re = re.compile(r'([a-z0-9_]+)\[([0-9]+\.\.[0-9]+)\]( *\( *0 *\) *)?( *= *)([0-9\.e\-\+]+)', flags=re.IGNORECASE)
+# any syntax of inits: name, index range, (0), value
+state_init_re = re.compile(r'([a-z0-9_]+)(?:\[([0-9]+)\.\.([0-9]+)\])? *(?:\( *0 *\))? *= *([0-9\.e\-\+]+)', flags=re.IGNORECASE)
+# v=*, v(0)=*, v[0..2](0)=*, v[0..2]=*, v[j]=*
+init_value_res = [value_re,
+                  re.compile(r'([a-z0-9_]+ *\( *0 *\)) *= *([0-9\.e\-\+]+)', flags=re.IGNORECASE),
+                  re.compile(r'([a-z0-9_]+\[[0-9]+\.\.[0-9]+\] *\( *0 *\)) *= *([0-9\.e\-\+]+)', flags=re.IGNORECASE),
+                  re.compile(r'([a-z0-9_]+\[[0-9]+\.\.[0-9]+\]) *= *([0-9\.e\-\+]+)', flags=re.IGNORECASE),
+                  re.compile(r'([a-z0-9_]+\[j\]) *= *([0-9\.e\-\+]+)', flags=re.IGNORECASE)]
+
 def file_to_lines(filepath):
     with open(filepath,"r") as f:
         content = f.readlines()
     return content
 
+def select_names(d, names):
+    """
+    d - a dict, names - the list of keys or None
+
+    return:
+    d if names is None, otherwise the dict with the given keys only
+    """
+    if names is None:
+        return d
+    else:
+        return {pn:d[pn] for pn in names}
+
+def state_vars_in_line(line, der, aux):
+    """
+    line - a line of an ODE-file
+    der, aux - the lists to which found names of state and auxiliary variables are appended
+    """
+    # find scalar vars
+    so_sc=state_var_sc_re.search(line)
+
+    # find array vars
+    so_ar=state_var_ar_re.search(line)
+
+
+    if so_sc is not None:
+
+        if so_sc.group(1) is not None:
+            der.append(so_sc.group(1).lower())
+        elif so_sc.group(2) is not None:
+            der.append(so_sc.group(2).lower())
+        else:
+            aux.append(so_sc.group(3).lower())
+
+    if so_ar is not None:
+        if so_ar.group(1) is not None:
+            # make sure array portion is nonempty
+            if so_ar.group(2) is not None:
+                # strip list brack off ends
+                indices = so_ar.group(2)[1:-1]
+
+                # get lower and upper numbers of list
+                indices = indices.split('..')
+
+                low_idx = int(indices[0])
+                hi_idx = int(indices[-1])
+                idxrange = np.arange(low_idx,hi_idx+1,1)
+                #print idxrange
+
+                for i in range(len(idxrange)):
+                    der.append(so_ar.group(1)+str(idxrange[i]).lower())
+
+        elif so_ar.group(2) is not None:
+            der.append(so_ar.group(2).lower())
+        else:
+            aux.append(so_ar.group(3).lower())
+
 def search_state_vars_in_srclines(srclines):
     """
     srclines - an ODE-file's content read into the list of strings,
@@ -55,45 +146,7 @@ def search_state_vars_in_srclines(srclines):
     # find scalar defined vars
     for line in srclines:
         #print line
-
-        # find scalar vars
-        so_sc=re.search('^ *d([a-zA-Z0-9_]+)/dt[ \t]*=|^ *([a-zA-Z0-9_]+)\'[ \t]*=|^ *aux +([a-zA-Z0-9_]+) *=', line, flags=re.IGNORECASE)
-
-        # find array vars
-        so_ar=re.search('^ *([a-zA-Z0-9_]+)(\[[0-9]+\.\.[0-9]+\])\'[ \t]*=|^ *aux +([a-zA-Z0-9_]+)(\[[0-9]+\.\.[0-9]+\]) *=', line, flags=re.IGNORECASE)
-        
-        
-        if so_sc is not None:
-            
-            if so_sc.group(1) is not None:
-                der.append(so_sc.group(1).lower())
-            elif so_sc.group(2) is not None:
-                der.append(so_sc.group(2).lower())
-            else:
-                aux.append(so_sc.group(3).lower())
-
-        if so_ar is not None:
-            if so_ar.group(1) is not None:
-                # make sure array portion is nonempty
-                if so_ar.group(2) is not None:
-                    # strip list brack off ends
-                    indices = so_ar.group(2)[1:-1]
-                    
-                    # get lower and upper numbers of list
-                    indices = indices.split('..') 
-                    
-                    low_idx = int(indices[0])
-                    hi_idx = int(indices[-1])
-                    idxrange = np.arange(low_idx,hi_idx+1,1)
-                    #print idxrange
-                    
-                    for i in range(len(idxrange)):
-                        der.append(so_ar.group(1)+str(idxrange[i]).lower())
-
-            elif so_ar.group(2) is not None:
-                der.append(so_ar.group(2).lower())
-            else:
-                aux.append(so_ar.group(3).lower())
+        state_vars_in_line(line, der, aux)
 
     return der+aux
 
@@ -107,14 +160,10 @@ def read_numerics_settings(srclines, num_names=None):
     """
     
     vars_list=[]
-    i_num_lines = np.nonzero([re.search('^ *(@) (.+)$', line, flags=re.IGNORECASE) is not None for line in srclines])[0]
-    for i in i_num_lines:
-        vars_list+=re.findall('([a-z0-9_]+) *= *([0-9\.e\-\+]+)', srclines[i].lower(), flags=re.IGNORECASE)
-    d = dict(vars_list)
-    if num_names is None:
-        return d
-    else:
-        return {pn:d[pn] for pn in num_names}
+    for line in srclines:
+        if num_line_re.search(line) is not None:
+            vars_list+=value_re.findall(line.lower())
+    return select_names(dict(vars_list), num_names)
 
 def read_numerics_settings_from_file(filepath, num_names=None):
     """
@@ -125,7 +174,7 @@ def read_numerics_settings_from_file(filepath, num_names=None):
     return:
     the dict of numerical options, where keys=num_names, values are parsed from .ode file
     """
-    return read_numerics_settings(file_to_lines(filepath), num_names=num_names)
+    return select_names(dict(load_model(filepath).numerics), num_names)
 
 
 
@@ -138,14 +187,10 @@ def read_pars_values(srclines, pars_names=None):
     the dict of parameters, where keys=pars_names, values are parsed from srclines
     """
     vars_list=[]
-    i_par_lines = np.nonzero([re.search('^ *(parameters|par|param|params|p) (.+)$', line, flags=re.IGNORECASE) is not None for line in srclines])[0]
-    for i in i_par_lines:
-        vars_list+=re.findall('([a-z0-9_]+) *= *([0-9\.e\-\+]+)', srclines[i].lower(), flags=re.IGNORECASE)
-    d = dict(vars_list)
-    if pars_names is None:
-        return d
-    else:
-        return {pn:d[pn] for pn in pars_names}
+    for line in srclines:
+        if par_line_re.search(line) is not None:
+            vars_list+=value_re.findall(line.lower())
+    return select_names(dict(vars_list), pars_names)
 
 def read_pars_values_from_file(filepath, pars_names=None):
     """
@@ -156,31 +201,203 @@ def read_pars_values_from_file(filepath, pars_names=None):
     return:
     the dict of parameters, where keys=pars_names, values are parsed from .ode file
     """
-    return read_pars_values(file_to_lines(filepath), pars_names=pars_names)
+    return select_names(dict(load_model(filepath).pars), pars_names)
+
+def value_to_str(value):
+    """
+    return:
+    the text of a new value in an ODE file, strings are taken as they are
+    """
+    return value if isinstance(value, str) else repr(float(value))
+
+
+class OdeTemplate(object):
+    """
+    An ODE file compiled for rewriting: the text between the values of parameters and initial conditions
+    is joined into literal pieces and every value is a slot, so that a modified file is made with one join,
+    whatever the length of the file and the number of changed values.
+    Use OdeModel.template or ode_template(srclines) to get a compiled template.
+
+    Ex.:
+    template = load_model('hh.ode').template
+    template.save('hh_new.ode', parameters={'i':10.}, inits={'v':-60.})
+    """
+
+    def __init__(self, srclines):
+        literals = []; texts = []; self.slots = {}
+        der = []; aux = []; declared = set()
+        done_line = -1
+        piece = []
+
+        def add_slot(key, text):
+            literals.append(''.join(piece))
+            del piece[:]
+            self.slots.setdefault(key, []).append(len(texts))
+            texts.append(text)
+
+        for i, line in enumerate(srclines):
+            state_vars_in_line(line, der, aux)
+            if done_line < 0 and done_line_re.search(line) is not None:
+                done_line = i
+                # inits of state variables that are not declared in the file go before 'done'
+                add_slot(('missing', None), '')
+
+            matches = []
+            if par_line_re.search(line) is not None:
+                matches = [('par', so) for so in par_value_re.finditer(line)]
+            else:
+                if init_ar_line_re.search(line) is not None:
+                    matches = [('array', so) for so in init_value_ar_re.finditer(line)]
+                if init_sc_line_re.search(line) is not None:
+                    taken = [so.span() for kind, so in matches]
+                    matches += [('init', so) for so in init_value_sc_re.finditer(line)
+                                if not any(a < so.end() and so.start() < b for a, b in taken)]
+                matches.sort(key=lambda m: m[1].start())
+
+            pos = 0
+            for kind, so in matches:
+                name = so.group(1).lower()
+                if kind == 'par':
+                    piece.append(line[pos:so.start(3)])
+                    add_slot(('par', name), so.group(3))
+                elif kind == 'init':
+                    piece.append(line[pos:so.start(4)])
+                    add_slot(('init', name), so.group(4))
+                    declared.add(name)
+                else:
+                    piece.append(line[pos:so.start()])
+                    lo, hi = so.group(2).split('..')
+                    add_slot(('array', name), (so.group(0), so.group(1), int(lo), int(hi), so.group(3)))
+                pos = so.end()
+            piece.append(line[pos:])
+
+        if done_line < 0:
+            add_slot(('missing', None), '')
+        literals.append(''.join(piece))
+
+        self.literals = literals
+        self.texts = texts
+        self.state_vars = set(der)
+        self.declared = declared
+        self.newline_before_missing = done_line < 0 and len(srclines) > 0 and not srclines[-1].endswith('\n')
+
+    def render(self, parameters=None, inits=None):
+        """
+        parameters - the dict of parameters to set up new values
+        inits - the dict of inits to set up new values, e.g. {'v':-60} or {'u':[1,2,3]} for an array u[1..3].
+                Inits of state variables that are not declared in the file are added in a new init line,
+                names that are neither declared nor state variables are ignored.
+
+        return:
+        the content of the modified ODE file, str
+        """
+        texts = list(self.texts)
+        slots = self.slots
+        for name, value in (parameters or {}).items():
+            for i in slots.get(('par', name.lower()), ()):
+                texts[i] = value_to_str(value)
+
+        missing = []
+        for name, value in (inits or {}).items():
+            name = name.lower()
+            if ('init', name) in slots:
+                for i in slots[('init', name)]:
+                    texts[i] = value_to_str(value)
+            elif ('array', name) in slots:
+                for i in slots[('array', name)]:
+                    texts[i] = self.array_text(texts[i], value)
+            elif name in self.state_vars:
+                missing.append('%s=%s' % (name, value_to_str(value)))
+        if missing:
+            line = 'init '+','.join(missing)+'\n'
+            for i in slots[('missing', None)]:
+                texts[i] = '\n'+line if self.newline_before_missing else line
+
+        parts = [None]*(2*len(texts)+1)
+        parts[::2] = self.literals
+        parts[1::2] = [t if isinstance(t, str) else t[0] for t in texts]
+        return ''.join(parts)
+
+    @staticmethod
+    def array_text(slot, values):
+        """
+        slot - (original text, name, first index, last index, '(0)' or None) of an array init, e.g. u[0..4]=1
+        values - the list of new values of the elements
+
+        return:
+        the inits of the elements, e.g. 'u0=1,u1=2' or 'u0(0)=1\nu1(0)=2' for the syntax u[0..1](0)=*
+        """
+        text, name, lo, hi, zero = slot
+        values = [value_to_str(v) for v in values]
+        if len(values) != hi-lo+1:
+            raise ValueError('make sure ode array numbers coincide with the number of initial conditions. e.g. if v[1..3](0)=1, v0(0)=2, and you want to change the inits to v0=1,v1=4,v2=5,v3=6, then use inits {\'v0\':1,\'v\':[4,5,6]}')
+        if zero is not None:
+            return '\n'.join('%s%d(0)=%s' % (name, j, v) for j, v in zip(range(lo, hi+1), values))
+        return ','.join('%s%d=%s' % (name, j, v) for j, v in zip(range(lo, hi+1), values))
+
+    def save(self, newfilepath, parameters=None, inits=None):
+        """
+        writes the modified ODE file to newfilepath, see render
+        """
+        with open(newfilepath, 'w') as f:
+            f.write(self.render(parameters, inits))
+
+
+# templates compiled by ode_template, {content of the file: OdeTemplate}
+template_cache = {}
+template_cache_size = 64
+
+def ode_template(srclines):
+    """
+    srclines - an ODE-file content in the list of strings
+
+    return:
+    OdeTemplate of the content, compiled once for the same content
+    """
+    key = ''.join(srclines)
+    template = template_cache.get(key)
+    if template is None:
+        template = OdeTemplate(srclines)
+        if len(template_cache) >= template_cache_size:
+            template_cache.clear()
+        template_cache[key] = template
+    return template
 
 def change_parameters_in_ode_and_save(srclines, parameters, newfilepath):
     """
     srclines - an ODE-file content in the list of strings,
-    parameters - the dict of parameters to set up new values, all keys in low register!
+    parameters - the dict of parameters to set up new values
     newfilepath - path to a new ODE file with modified parameters
     """
-    lparameters = {pn.lower():(lambda x: repr(x) if not isinstance(x,str) else x)(pv) for pn,pv in parameters.items()}
-    pnames = lparameters.keys()
-    def repl_in_par(matchobj):
-        mog = matchobj.group(1).lower()
-        if mog in pnames:
-           return matchobj.group(1)+matchobj.group(2)+lparameters[mog]
-        else:
-           return matchobj.group(0)
+    ode_template(srclines).save(newfilepath, parameters=parameters)
+
+def init_values_in_line(line, vars_lists):
+    """
+    line - a line of an ODE-file with initial conditions
+    vars_lists - five lists to which found (name, value) are appended,
+                 for the syntax v=*, v(0)=*, v[0..2](0)=*, v[0..2]=*, v[j]=*
+    """
+    line = line.lower()
+    for vars_list, init_value_re in zip(vars_lists, init_value_res):
+        vars_list+=init_value_re.findall(line)
+
+def init_values_to_dict(vars_lists):
+    """
+    vars_lists - five lists filled by init_values_in_line
+
+    return:
+    the dict of initial conditions
+    """
+    vars_list_sc1, vars_list_sc2, vars_list_ar1, vars_list_ar2, vars_list_ar3 = vars_lists
 
-    i_par_lines = np.nonzero([re.search('^ *(parameters|par|param|params|p) (.+)$', line, flags=re.IGNORECASE) is not None for line in srclines])[0]
-    nsrclines=srclines[:]
-    for i in i_par_lines:
-        nsrclines[i] = re.sub('([a-z0-9_]+)( *= *)([0-9\.e\-\+]+)', repl_in_par, nsrclines[i], flags=re.IGNORECASE)
-    nsrc = ''.join(nsrclines)
-    with open(newfilepath, 'w') as f:
-        f.write(nsrc)
+    # remove '(0)' from vars_list_sc2 and vars_list_ar1
+    vars_list_sc2 = [(var[:-3], val) for var, val in vars_list_sc2]
+    vars_list_ar1 = [(var[:-3], val) for var, val in vars_list_ar1]
 
+    # implement remove '(0)' from vars_list_ar2
+    #print vars_list_sc1,vars_list_ar2
+    vars_list = vars_list_sc1 + vars_list_sc2 + vars_list_ar1 + vars_list_ar2 + vars_list_ar3
+    return dict(vars_list)
 
 def read_init_values(srclines, init_names=None):
     """ srclines - an ODE-file content in the list of strings,
@@ -191,43 +408,11 @@ def read_init_values(srclines, init_names=None):
     the dict of parameters, where keys=pars_names, values are parsed from srclines
     """
 
-    vars_list_sc1=[];vars_list_sc2=[];vars_list_ar1=[];vars_list_ar2=[];vars_list_ar3=[]
-    i_init_lines = np.nonzero([re.search(init_re_sc1+'|'+\
-                                         init_re_sc2+'|'+\
-                                         init_re_ar1+'|'+\
-                                         init_re_ar2, line, flags=re.IGNORECASE) is not None for line in srclines])[0]
-
-    for i in i_init_lines:
-        vars_list_sc1+=re.findall('([a-z0-9_]+) *= *([0-9\.e\-\+]+)',srclines[i].lower(),flags=re.IGNORECASE)
-        vars_list_sc2+=re.findall('([a-z0-9_]+ *\( *0 *\)) *= *([0-9\.e\-\+]+)',srclines[i].lower(),flags=re.IGNORECASE)
-        vars_list_ar1+=re.findall('([a-z0-9_]+\[[0-9]+\.\.[0-9]+\] *\( *0 *\)) *= *([0-9\.e\-\+]+)',srclines[i].lower(),flags=re.IGNORECASE)
-        vars_list_ar2+=re.findall('([a-z0-9_]+\[[0-9]+\.\.[0-9]+\]) *= *([0-9\.e\-\+]+)',srclines[i].lower(),flags=re.IGNORECASE)
-        vars_list_ar3+=re.findall('([a-z0-9_]+\[j\]) *= *([0-9\.e\-\+]+)',srclines[i].lower(),flags=re.IGNORECASE)
-
-    # remove '(0)' from vars_list_sc2
-    for i in range(len(vars_list_sc2)):
-        tup = vars_list_sc2[i]
-        var = tup[0]
-        var_pruned = var[:-3]
-        tup2 = (var_pruned,tup[1])
-        vars_list_sc2[i] = tup2
-
-    # remove '(0)' from vars_list_ar1
-    for i in range(len(vars_list_ar1)):
-        tup = vars_list_ar1[i]
-        var = tup[0]
-        var_pruned = var[:-3]
-        tup2 = (var_pruned,tup[1])
-        vars_list_ar1[i] = tup2
-
-    # implement remove '(0)' from vars_list_ar2
-    #print vars_list_sc1,vars_list_ar2
-    vars_list = vars_list_sc1 + vars_list_sc2 + vars_list_ar1 + vars_list_ar2 + vars_list_ar3
-    d = dict(vars_list)
-    if init_names is None:
-        return d
-    else:
-        return {pn:d[pn] for pn in init_names}
+    vars_lists = ([], [], [], [], [])
+    for line in srclines:
+        if init_line_re.search(line) is not None:
+            init_values_in_line(line, vars_lists)
+    return select_names(init_values_to_dict(vars_lists), init_names)
 
 def read_init_values_from_file(filepath, init_names=None):
     """
@@ -238,216 +423,1415 @@ def read_init_values_from_file(filepath, init_names=None):
     return:
     the dict of parameters, where keys=pars_names, values are parsed from .ode file
     """
-    return read_init_values(file_to_lines(filepath), init_names=init_names)
+    return select_names(dict(load_model(filepath).inits), init_names)
 
 
 def change_inits_in_ode_and_save(srclines, inits, newfilepath):
     """
     srclines - an ODE-file content in the list of strings,
-    inits - the dict of inits to set up new values, all keys in low register!
+    inits - the dict of inits to set up new values, e.g. {'v':-60} or {'u':[1,2,3]} for an array u[1..3].
+            Inits of state variables that are not declared in the file are added in a new init line.
     newfilepath - path to a new ODE file with modified inits
     """
+    ode_template(srclines).save(newfilepath, inits=inits)
+
+def check_if_in_ode(srclines,inits):
+    """
+    DEPRECATED 
     
-    linits = {pn.lower():(lambda x: repr(x) if not isinstance(x,str) else x)(pv) for pn,pv in inits.items()}
-    pnames = linits.keys()
+    check whether a set of inits are listed in an ODE
+    return {dictonary of existing guys}, {dictionary of nonexisting guys}
+    """
+    i_par_lines = np.nonzero([re.search(init_re_sc1+'|'+\
+                                        init_re_sc2+'|'+\
+                                        init_re_ar1+'|'+\
+                                        init_re_ar2, line, flags=re.IGNORECASE) is not None for line in srclines])[0]
+    return i_par_lines
+
+
+def parse_output(data, dtype=np.float64):
+    """
+    data - the content of a file written by xpp (output.dat), bytes: rows of numbers separated by spaces
+    dtype - np.float64 or np.float32
+
+    return:
+    C-contiguous numpy.array of shape (number of rows, number of columns)
+    """
+    first = data.split(b'\n', 1)[0]
+    ncols = len(first.split())
+    if ncols == 0:
+        return np.empty((0, 0), dtype=dtype)
+
+    # one vectorized conversion of all numbers, the trailing spaces and newlines are just separators
+    values = np.fromstring(data, dtype=dtype, sep=' ')
+    nrows = data.count(b'\n') + (0 if data.endswith(b'\n') else 1)
+    if values.size != nrows*ncols:
+        # unparsable numbers or ragged rows, let genfromtxt deal with them
+        return np.atleast_2d(np.genfromtxt(io.BytesIO(data), delimiter=' ', dtype=dtype))
+    return values.reshape(nrows, ncols)
+
+def output_shape(data):
+    """
+    Checks an output of xpp without parsing the numbers.
+
+    data - the content of a file written by xpp (output.dat), bytes
+
+    return:
+    (number of rows, number of columns). ValueError is raised if the output is cut (e.g. xpp has crashed while writing it)
+    or its rows have different numbers of values.
+    """
+    b = np.frombuffer(data, dtype=np.uint8)
+    blank = b <= 32 # spaces, tabs and newlines
+    if blank.all():
+        return 0, 0
+    end = len(b)-int(blank[::-1].argmin()) # after the last number
+    if data.find(b'\n', end) < 0:
+        raise ValueError('the last row of the output is not complete')
+    nrows = data.count(b'\n', 0, end)+1
+    ncols = len(data[:data.find(b'\n')].split())
+    last = data[data.rfind(b'\n', 0, end)+1:end].split()
+    # a number starts at a non-blank byte after a blank one
+    nvalues = int(np.count_nonzero(blank[:-1] > blank[1:]))+int(not blank[0])
+    if len(last) != ncols or nvalues != nrows*ncols:
+        raise ValueError('the rows of the output have different numbers of values')
+    return nrows, ncols
+
+def iter_output_chunks(filepath, dtype=np.float64, usecols=None, chunk_bytes=2**22):
+    """
+    Reads a file written by xpp piece by piece, the memory does not depend on the size of the file.
+
+    filepath - path to the output file (output.dat)
+    dtype - np.float64 or np.float32
+    usecols - the list of indices of columns to keep, all columns if None
+    chunk_bytes - approximate size of a piece of the file
+
+    return:
+    generator of 2-D numpy.arrays, consecutive rows of the file.
+    ValueError is raised if the last row is not complete or the rows have different numbers of values.
+    """
+    ncols = None
+    with open(filepath, 'rb') as f:
+        rest = b''
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                break
+            data = rest+data
+            # a chunk ends at the end of a row, the incomplete row is left for the next one
+            end = data.rfind(b'\n')+1
+            if end == 0:
+                rest = data
+                continue
+            rest = data[end:]
+            chunk = parse_output(data[:end], dtype=dtype)
+            if ncols is None:
+                ncols = chunk.shape[1]
+            elif chunk.shape[1] != ncols and chunk.size:
+                raise ValueError('the rows of the output have different numbers of values')
+            yield chunk if usecols is None else chunk[:, usecols]
+        if rest.strip():
+            # xpp ends every row with a newline, the file has been cut
+            raise ValueError('the last row of the output is not complete')
+
+def load_output(filepath, dtype=np.float64, usecols=None):
+    """
+    A fast replacement of np.genfromtxt(filepath, delimiter=' ') for files written by xpp.
+
+    filepath - path to the output file (output.dat)
+    dtype - np.float64 or np.float32
+    usecols - the list of indices of columns to keep, all columns if None.
+              The file is read in chunks and other columns are dropped at once, so the memory scales with len(usecols).
+
+    return:
+    C-contiguous numpy.array of shape (number of rows, number of columns), always 2-D
+    """
+    if usecols is not None:
+        chunks = list(iter_output_chunks(filepath, dtype=dtype, usecols=usecols))
+        if not chunks:
+            return np.empty((0, len(usecols)), dtype=dtype)
+        return np.ascontiguousarray(np.concatenate(chunks))
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    return parse_output(data, dtype=dtype)
+
+def load_output_tail(filepath, rows, dtype=np.float64, usecols=None, block_bytes=2**16):
+    """
+    Reads only the last rows of a file written by xpp, the file is read backwards from its end
+    until enough rows are found, so the time does not depend on the length of the file.
+
+    filepath - path to the output file (output.dat)
+    rows - the number of last rows to read
+    dtype - np.float64 or np.float32
+    usecols - the list of indices of columns to keep, all columns if None
+
+    return:
+    C-contiguous numpy.array of shape (min(rows, number of rows of the file), number of columns), always 2-D.
+    ValueError is raised if the last row is not complete or the rows have another number of values than the first row.
+    """
+    if rows < 1:
+        raise ValueError('the number of rows should be at least 1')
+    with open(filepath, 'rb') as f:
+        ncols = len(f.readline().split())
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b''
+        while pos > 0:
+            step = min(block_bytes, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step)+data
+            block_bytes *= 2
+            # rows line ends before the end of the last row: the tail starts after the first of them
+            if data.rstrip().count(b'\n') >= rows:
+                break
+    if data.strip() and data.find(b'\n', len(data.rstrip())) < 0:
+        raise ValueError('the last row of the output is not complete')
+    body = b'\n'.join(data.rstrip().rsplit(b'\n', rows)[-rows:])
+    out = parse_output(body+b'\n', dtype=dtype) if body.strip() else np.empty((0, 0), dtype=dtype)
+    if out.size and out.shape[1] != ncols:
+        raise ValueError('the rows of the output have different numbers of values')
+    return out if usecols is None or out.shape[1] == 0 else np.ascontiguousarray(out[:, usecols])
+
+
+class Result(object):
+    """
+    The result of xpprun. It unpacks as the tuple (out, vn), so npa, vn = xpprun(...) works as before,
+    and gives the columns of variables by name:
+
+    res = xpprun('hh.ode')
+    plt.plot(res.t, res['v'])
+    res = xpprun('wc.ode')
+    res['u'] # 2-D array of u0..u5, time along the first axis, a view of out if the columns are equally spaced
+
+    The output is parsed at the first access to out or to a variable.
 
-    def repl_in_par(matchobj):
+    Attributes:
+
+    out - numpy.array where out[:,0] is time, and out[:,1:] is the matrix with solutions for model variables
+    vn - the list of names of variables, the order of columns out[:,1:]
+    t - out[:,0]
+    """
+    __slots__ = ('_out', '_data', '_dtype', 'vn', '_columns', '_arrays')
+
+    def __init__(self, out=None, vn=None, data=None, dtype=np.float64):
         """
-        replace scalar inits
+        out - numpy.array, or None if it is to be parsed from data
+        vn - the list of names of variables
+        data - the content of an output file of xpp (bytes)
         """
-        
-        mog = matchobj.group(1).lower()
-        # if init is used as v(0)=*, account for this fact.
-        if matchobj.group(2) != None:
+        self._out = out
+        self._data = data
+        self._dtype = dtype
+        self.vn = vn
+        self._columns = None
+        self._arrays = None
+
+    @property
+    def out(self):
+        if self._out is None:
+            self._out = parse_output(self._data, dtype=self._dtype)
+            self._data = None
+        return self._out
+
+    @property
+    def t(self):
+        return self.out[:, 0]
+
+    @property
+    def columns(self):
+        """
+        the dict {name of variable: index of its column in out}
+        """
+        if self._columns is None:
+            self._columns = {v:i+1 for i, v in enumerate(self.vn)}
+        return self._columns
 
-            if mog in pnames:
-                out = matchobj.group(1)+matchobj.group(2)+matchobj.group(3)+linits[mog]
-                out = out.replace(" ","")
-                return out
-            else:
-                out = matchobj.group(0)
-                out = out.replace(" ","")
-                return out
-        else:
+    @property
+    def arrays(self):
+        """
+        the dict {name of array: list of indices of columns of its elements}, e.g. {'u': [1, 2, 3]} for u0, u1, u2
+        """
+        if self._arrays is None:
+            groups = {}
+            for v, i in self.columns.items():
+                so = re.search('^(.*[^0-9])([0-9]+)$', v)
+                if so is not None:
+                    groups.setdefault(so.group(1), []).append((int(so.group(2)), i))
+            self._arrays = {name:[i for j, i in sorted(idx)] for name, idx in groups.items() if name not in self.columns}
+        return self._arrays
+
+    def __getitem__(self, key):
+        """
+        res[name] - the column of a variable, or the 2-D array of the columns of an array variable
+        res[0], res[1] - out and vn as for the tuple (out, vn)
+        """
+        if isinstance(key, (int, np.integer)):
+            return (self.out, self.vn)[key]
+        key = key.lower()
+        i = self.columns.get(key)
+        if i is not None:
+            return self.out[:, i]
+        idx = self.arrays.get(key)
+        if idx is None:
+            raise KeyError('no variable %s, variables are %s' % (key, ', '.join(self.vn)))
+        steps = np.diff(idx)
+        if len(idx) == 1 or (steps[0] > 0 and np.all(steps == steps[0])):
+            # equally spaced columns are a view, not a copy
+            step = steps[0] if len(idx) > 1 else 1
+            return self.out[:, idx[0]:idx[-1]+1:step]
+        return self.out[:, idx]
+
+    def __contains__(self, key):
+        return key.lower() in self.columns or key.lower() in self.arrays
+
+    def keys(self):
+        return list(self.vn)
+
+    def __iter__(self):
+        return iter((self.out, self.vn))
+
+    def __len__(self):
+        return 2
+
+    def __getstate__(self):
+        # parsed before pickling, e.g. to send from a worker of xpprun_batch
+        return self.out, self.vn
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        shape = self._out.shape if self._out is not None else 'not parsed'
+        return '<Result %s, variables %s>' % (shape, ', '.join(self.vn[:10])+(', ...' if len(self.vn) > 10 else ''))
+
+
+class Reducer(object):
+    """
+    A summary of a trajectory computed chunk by chunk while the output of xpp is read,
+    so that the whole output is never held in memory.
+    Pass a dict of reducers to xpprun(..., reducers={'vmax': Max('v'), 'spikes': Crossings('v', 0)}),
+    xpprun returns the dict of summaries {'vmax': ..., 'spikes': ...} instead of Result.
 
-            if mog in pnames:
-                out = matchobj.group(1)+matchobj.group(3)+linits[mog]
-                out = out.replace(" ","")
-                return out
-            else:
-                out = matchobj.group(0)
-                out = out.replace(" ","")
-                return out
+    A reducer keeps no state itself, the same instance serves many runs:
+    state = reducer.begin(); state = reducer.update(state, chunk) for every chunk (Result of consecutive rows);
+    reducer.end(state) is the summary.
+
+    var - the name of the variable ('t' for time), None for all of them
+    """
+
+    def __init__(self, var=None):
+        self.var = None if var is None else var.lower()
+
+    def values(self, chunk):
+        return chunk.t if self.var == 't' else chunk[self.var]
+
+    def begin(self):
+        return None
+
+    def update(self, state, chunk):
+        return state
+
+    def end(self, state):
+        return state
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.var)
+
+
+class Min(Reducer):
+    """
+    the minimum of a variable, nan if there is no output
+    """
+
+    def update(self, state, chunk):
+        v = self.values(chunk)
+        if len(v) == 0:
+            return state
+        m = v.min()
+        return m if state is None else min(state, m)
+
+    def end(self, state):
+        return np.nan if state is None else state
+
+
+class Max(Min):
+    """
+    the maximum of a variable, nan if there is no output
+    """
+
+    def update(self, state, chunk):
+        v = self.values(chunk)
+        if len(v) == 0:
+            return state
+        m = v.max()
+        return m if state is None else max(state, m)
+
+
+class Mean(Reducer):
+    """
+    the mean of a variable over the rows of the output, nan if there is no output
+    """
+
+    def begin(self):
+        return (0., 0)
+
+    def update(self, state, chunk):
+        v = self.values(chunk)
+        return (state[0]+float(np.sum(v, dtype=np.float64)), state[1]+len(v))
 
-    def repl_in_ar(matchobj):
+    def end(self, state):
+        return state[0]/state[1] if state[1] else np.nan
+
+
+class Last(Reducer):
+    """
+    the last value of a variable, or with var=None the dict {name: last value} of all variables (the final state)
+    """
+
+    def update(self, state, chunk):
+        if len(chunk.out) == 0:
+            return state
+        if self.var is None:
+            return dict(zip(chunk.vn, chunk.out[-1, 1:]))
+        return self.values(chunk)[-1]
+
+    def end(self, state):
+        return np.nan if state is None else state
+
+
+class Crossings(Reducer):
+    """
+    the times when a variable crosses the threshold, numpy.array, linear interpolation between the time points.
+    Spike times of hh.ode: Crossings('v', 0), the number of spikes is len of the summary.
+
+    direction - 'up' (from below to the threshold or above), 'down' or 'both'
+    """
+
+    def __init__(self, var, threshold=0., direction='up'):
+        Reducer.__init__(self, var)
+        if direction not in ('up', 'down', 'both'):
+            raise ValueError("direction should be 'up', 'down' or 'both'")
+        self.threshold = threshold
+        self.direction = direction
+
+    def begin(self):
+        # the last time point of the previous chunk, its value, the times of crossings
+        return (None, None, [])
+
+    def update(self, state, chunk):
+        pt, pv, times = state
+        t = chunk.t; v = self.values(chunk)
+        if len(t) == 0:
+            return state
+        if pt is not None:
+            t = np.concatenate([[pt], t]); v = np.concatenate([[pv], v])
+        a = v[:-1]-self.threshold; b = v[1:]-self.threshold
+        up = (a < 0) & (b >= 0)
+        down = (a >= 0) & (b < 0)
+        mask = up if self.direction == 'up' else down if self.direction == 'down' else up | down
+        idx = np.nonzero(mask)[0]
+        times.extend(t[idx]+a[idx]/(a[idx]-b[idx])*(t[idx+1]-t[idx]))
+        return (t[-1], v[-1], times)
+
+    def end(self, state):
+        return np.array(state[2])
+
+    def __repr__(self):
+        return '%s(%r, %r, %r)' % (self.__class__.__name__, self.var, self.threshold, self.direction)
+
+
+class Period(Crossings):
+    """
+    the period of oscillations of a variable: the mean interval between its upward crossings of the threshold,
+    nan if there are less than two crossings
+    """
+
+    def __init__(self, var, threshold=0.):
+        Crossings.__init__(self, var, threshold, 'up')
+
+    def end(self, state):
+        times = state[2]
+        return (times[-1]-times[0])/(len(times)-1) if len(times) > 1 else np.nan
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.var, self.threshold)
+
+
+class Fold(Reducer):
+    """
+    a custom reducer: state = func(state, chunk) for every chunk (Result of consecutive rows), starting with initial.
+    A plain function in the dict of reducers is taken as Fold(function).
+    Use functions defined at the top level of a module with xpprun_batch(..., pool='process'), lambdas are not picklable.
+
+    Ex.: the number of time points where v > 0
+    Fold(lambda n, chunk: n+np.sum(chunk['v'] > 0), 0)
+    """
+
+    def __init__(self, func, initial=None):
+        Reducer.__init__(self)
+        self.func = func
+        self.initial = initial
+
+    def begin(self):
+        return self.initial
+
+    def update(self, state, chunk):
+        return self.func(state, chunk)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.func)
+
+
+def as_reducer(reducer):
+    return reducer if isinstance(reducer, Reducer) else Fold(reducer)
+
+def reduce_chunks(reducers, chunks):
+    """
+    reducers - the dict {name: Reducer or function}
+    chunks - iterable of Result, consecutive rows of the output
+
+    return:
+    the dict {name: summary}
+    """
+    reducers = {name: as_reducer(r) for name, r in reducers.items()}
+    states = {name: r.begin() for name, r in reducers.items()}
+    for chunk in chunks:
+        for name, r in reducers.items():
+            states[name] = r.update(states[name], chunk)
+    return {name: r.end(states[name]) for name, r in reducers.items()}
+
+def reducer_variables(reducers):
+    """
+    return:
+    the list of names of variables needed by the reducers, None if some of them need all variables
+    """
+    names = []
+    for r in reducers.values():
+        if not isinstance(r, Reducer) or isinstance(r, Fold) or r.var is None:
+            return None
+        if r.var != 't' and r.var not in names:
+            names.append(r.var)
+    return names
+
+
+class OdeModel(object):
+    """
+    The content of an ODE file parsed in one pass.
+    Use load_model(filepath) to get a cached model instead of parsing the file every time.
+
+    Attributes:
+
+    filepath - path to the .ode file (None if made from lines)
+    srclines - the content of the file, the list of strings. Do not modify it, it is shared by all users of the cache.
+    state_vars - the list of names of state variables
+    aux_vars - the list of names of auxiliary variables
+    variables - state_vars+aux_vars, the order of columns out[:,1:] of xpp output (vn of xpprun)
+    pars - the dict of parameters as in read_pars_values
+    inits - the dict of initial conditions as in read_init_values
+    numerics - the dict of numerical options as in read_numerics_settings
+    arrays - the dict {name: (first index, last index)} of array state variables, e.g. {'u': (0, 5)} for u[0..5]'=...
+    init_arrays - the same dict for array inits, e.g. {'u': (0, 4)} for init u[0..4]=1
+    state_inits - the dict {state variable: initial value} with arrays expanded, e.g. {'u0': '1', 'u1': '1'} for init u[0..1]=1
+    par_lines, num_lines - indices of lines with parameters and numerical options
+    init_lines, ar_init_lines - indices of lines with scalar and array initial conditions
+    aux_lines - the dict {name of auxiliary variable: index of its line}
+    done_line - index of the line 'done' ('d'), -1 if there is none
+    blocks - True if the file has %[..] blocks, then state_vars misses the variables declared in them
+    """
+
+    def __init__(self, srclines, filepath=None):
+        self.filepath = filepath
+        self.srclines = srclines
+
+        der=[]; aux=[]; pars=[]; numerics=[]; inits=([], [], [], [], [])
+        self.arrays={}; self.init_arrays={}; self.state_inits={}; self.aux_lines={}
+        self.par_lines=[]; self.num_lines=[]; self.init_lines=[]; self.ar_init_lines=[]
+        self.done_line = -1
+        self.blocks = False
+        self._template = None
+
+        for i, line in enumerate(srclines):
+            naux = len(aux)
+            state_vars_in_line(line, der, aux)
+            if len(aux) > naux:
+                self.aux_lines[aux[-1]] = i
+
+            so_ar = state_var_ar_re.search(line)
+            if (so_ar is not None) and (so_ar.group(1) is not None):
+                lo, hi = so_ar.group(2)[1:-1].split('..')
+                self.arrays[so_ar.group(1).lower()] = (int(lo), int(hi))
+
+            if par_line_re.search(line) is not None:
+                self.par_lines.append(i)
+                pars+=value_re.findall(line.lower())
+
+            if num_line_re.search(line) is not None:
+                self.num_lines.append(i)
+                numerics+=value_re.findall(line.lower())
+
+            if init_line_re.search(line) is not None:
+                init_values_in_line(line, inits)
+                for vname, lo, hi, value in state_init_re.findall(line.lower()):
+                    if lo == '':
+                        self.state_inits[vname] = value
+                    else:
+                        self.init_arrays[vname] = (int(lo), int(hi))
+                        for j in range(int(lo), int(hi)+1):
+                            self.state_inits[vname+str(j)] = value
+                if init_sc_line_re.search(line) is not None:
+                    self.init_lines.append(i)
+                if init_ar_line_re.search(line) is not None:
+                    self.ar_init_lines.append(i)
+
+            if self.done_line < 0 and done_line_re.search(line) is not None:
+                self.done_line = i
+
+            if block_line_re.search(line) is not None:
+                self.blocks = True
+
+        self.state_vars = der
+        self.aux_vars = aux
+        self.variables = der+aux
+        self.pars = dict(pars)
+        self.numerics = dict(numerics)
+        self.inits = init_values_to_dict(inits)
+
+    @classmethod
+    def from_file(cls, filepath):
+        return cls(file_to_lines(filepath), filepath=filepath)
+
+    @property
+    def template(self):
         """
-        replace array inits
+        OdeTemplate of the file, compiled at the first use
         """
+        if self._template is None:
+            self._template = OdeTemplate(self.srclines)
+        return self._template
 
-        mog = matchobj.group(1).lower()
+    def initial_state(self, inits=None):
+        """
+        inits - the dict of inits to set up new values as in xpprun, e.g. {'v':-60}, {'u':[1,2,3]} for an array u[1..3], or {'u':0} for all its elements.
+                A list of values is for the index range of the array init of the file (init u[1..3]=...), if there is one,
+                otherwise for the range of the array.
+
+        return:
+        the list of initial values of all state variables in the order of state_vars.
+        The inits of the file are used for the variables missing in inits, 0 if they are not in the file either.
+        Names which are not state variables are ignored.
+        """
+        values = {name.lower():self.state_inits.get(name.lower(), 0) for name in self.state_vars}
+        for k, v in (inits or {}).items():
+            k = k.lower()
+            if (k in self.arrays or k in self.init_arrays) and (k not in values):
+                lo, hi = self.init_arrays.get(k, self.arrays.get(k))
+                v = np.ravel(v)
+                if len(v) == 1: # the same value for all elements
+                    v = np.repeat(v, hi-lo+1)
+                if len(v) != hi-lo+1:
+                    raise ValueError('make sure ode array numbers coincide with the number of initial conditions, %s[%d..%d] needs %d values' % (k, lo, hi, hi-lo+1))
+                for j, vj in zip(range(lo, hi+1), v):
+                    values[k+str(j)] = vj
+            elif k in values:
+                values[k] = v
+        return [values[name.lower()] for name in self.state_vars]
+
+    def projection(self, variables, strip_aux=False):
+        """
+        variables - the list of names of variables to keep in the output
+        strip_aux - if True, the auxiliary variables missing in variables are to be removed from the .ode file
 
-        # if init is used as v(0)=*, account for this fact.
-        #print matchobj.group(1),'/',matchobj.group(2),'/',matchobj.group(3),'/',matchobj.group(4)
+        return:
+        usecols - the list of indices of columns of xpp output to keep, time (0) is the first one
+        vn - the list of names of kept variables, the same as variables in low register
+        aux_lines - the list of indices of lines to remove from the .ode file ([] if strip_aux is False)
+        """
+        vn = [v.lower() for v in variables]
+        columns = [v.lower() for v in self.variables]
+        aux_lines = []
+        if strip_aux:
+            dropped = [a for a in self.aux_vars if a.lower() not in vn]
+            aux_lines = sorted(self.aux_lines[a] for a in dropped)
+            columns = [v for v in columns if v not in set(a.lower() for a in dropped)]
+        missing = [v for v in vn if v not in columns]
+        if missing:
+            raise ValueError('no variables %s in the model, its variables are %s' % (', '.join(missing), ', '.join(self.variables)))
+        usecols = [0]+[1+columns.index(v) for v in vn]
+        return usecols, vn, aux_lines
+
+    def icfile_values(self, inits):
+        """
+        inits - the dict of inits as in initial_state
 
-        # get idx limits
-        idx = matchobj.group(2)
-        idx = idx.split('..')
-        low_idx = int(idx[0])
-        hi_idx = int(idx[-1])
-        idxrange = np.arange(low_idx,hi_idx+1,1)
+        return:
+        the list of initial values of all state variables for 'xppaut -icfile' (initial_state),
+        or None if the file of initial conditions would not give the same inits as rewriting the .ode file by name:
+        the model has %[..] blocks (state_vars is incomplete), or a name of inits is neither a state variable
+        nor an array init of the file whose elements are all state variables
+        """
+        if self.blocks:
+            return None
+        state_vars = set(self.state_vars)
+        for k in inits:
+            k = k.lower()
+            if k in self.init_arrays:
+                lo, hi = self.init_arrays[k]
+                if any(k+str(j) not in state_vars for j in range(lo, hi+1)):
+                    return None
+            elif k not in state_vars:
+                return None
+        return self.initial_state(inits)
+
+    def write_icfile(self, values, icfilepath):
+        """
+        writes the file of initial conditions for 'xppaut -icfile', one number per state variable and line
+        values - the list of initial values of all state variables (icfile_values)
+        """
+        with open(icfilepath, 'w') as f:
+            f.write(''.join('%r\n' % float(v) for v in values))
 
-        #print idx,idxrange
 
-        # if the init contains (0), keep it. no particular reason, but sorta easier this way?
-        if matchobj.group(3) != None:
-            #print 'sdfjkadsfasfd',mog
+# models parsed by load_model, {absolute path: ((mtime, size), OdeModel)}
+model_cache = {}
+model_cache_lock = threading.Lock()
 
-            if mog in pnames:
-                # collect all inits into one explicit line
-                # this is where we convert from v[0..2]=1 syntax to v0=1,v1=1,v2=1 syntax.
-                #print mog
-                listval = linits[mog][1:-1]
-                listval = listval.split(',')
+def load_model(filepath):
+    """
+    filepath - path to a .ode file
 
-                #print listval
+    return:
+    OdeModel of the file. The file is parsed again only if its modification time or size has changed since the last call.
+    """
+    filepath = os.path.abspath(filepath)
+    st = os.stat(filepath)
+    key = (st.st_mtime, st.st_size)
+    with model_cache_lock:
+        cached = model_cache.get(filepath)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    model = OdeModel.from_file(filepath)
+    with model_cache_lock:
+        model_cache[filepath] = (key, model)
+    return model
+
+
+def run_numerics(model, numerics=None, every=None, t_from=None):
+    """
+    model - OdeModel
+    numerics - the dict of numerical options to override, e.g. {'total':100, 'dt':.01, 'njmp':10, 'meth':'euler'}
+    every - keep every k-th time point of the output: njmp of the run is multiplied by every
+    t_from - keep only time points t >= t_from (the option trans of xpp)
 
-                if len(listval) != len(idxrange):
-                    raise ValueError('make sure ode array numbers coincide with the number of initial conditions. e.g. if v[1..3](0)=1, v0(0)=2, and you want to change the inits to v0=1,v1=4,v2=5,v3=6, then use inits {\'v0\':1,\'v\':[4,5,6]}')
+    return:
+    the dict of numerical options for xpp, names in low register
+    """
+    num = {k.lower():v for k,v in (numerics or {}).items()}
+    if every is not None:
+        njmp = num.get('njmp', num.get('nout', model.numerics.get('njmp', model.numerics.get('nout', 1))))
+        num['njmp'] = int(float(njmp))*int(every)
+        num.pop('nout', None)
+    if t_from is not None:
+        num['trans'] = t_from
+    return num
+
+# numerical options of xpp that set the time points of the output, and their defaults
+output_numerics = {'total': 20., 'dt': .05, 'njmp': 1., 't0': 0., 'trans': 0.}
+
+def output_rows(model, numerics=None):
+    """
+    model - OdeModel
+    numerics - the dict of numerical options of the run (as returned by run_numerics), they override those of the file
 
-                inits_new = ''
-                for i in range(len(idxrange)):
-                    #print idxrange[i]
-                    inits_new += matchobj.group(1)+str(idxrange[i])+matchobj.group(3)+'='+listval[i]+'\n'
+    return:
+    the number of time points in the output: every njmp-th of the total/dt steps from t0, those with t >= trans
+    """
+    num = dict(output_numerics)
+    for options in (model.numerics, numerics or {}):
+        options = {k.lower():v for k,v in options.items()}
+        if 'nout' in options and 'njmp' not in options:
+            options['njmp'] = options['nout']
+        num.update((k, float(options[k])) for k in output_numerics if k in options)
+    nsteps = int(round(num['total']/num['dt']))
+    njmp = max(1, int(num['njmp']))
+    # the first step at or after trans, rounded up to a multiple of njmp
+    first = max(0, int(np.ceil((num['trans']-num['t0'])/num['dt']-1e-9)))
+    first = -(-first//njmp)*njmp
+    return 0 if first > nsteps else (nsteps-first)//njmp+1
+
+def numerics_to_srclines(srclines, numerics, done_line=-1):
+    """
+    srclines - an ODE-file content in the list of strings, it is modified
+    numerics - the dict of numerical options
+    done_line - index of the line 'done', the options are added before it (to the end if -1)
+    """
+    line = '@ '+','.join('%s=%s' % (k, v) for k, v in sorted(numerics.items()))+'\n'
+    if done_line < 0:
+        srclines.append(line)
+    else:
+        srclines.insert(done_line, line)
 
-                # trim trailing comma, force newline
-                inits_new = inits_new[:-1]
-                inits_new = inits_new.replace(" ","")
-                
-                return inits_new
 
-                #print inits_new
-            else:
-                
-                return matchobj.group(0)
+def xpp_command(xppname):
+    """
+    xppname - name of xpp as you call it from Terminal (str), or the list of arguments that start it,
+              e.g. ['python', 'fake_xppaut.py']
+
+    return:
+    the list of arguments for subprocess
+    """
+    if isinstance(xppname, (list, tuple)):
+        return list(xppname)
+    return [xppname]
+
+
+def find_executable(name):
+    """
+    return:
+    the full path of the program name found in PATH (or name itself if it is a path), None if not found
+    """
+    try:
+        from shutil import which
+    except ImportError: # python 2
+        from distutils.spawn import find_executable as which
+    return which(name)
+
+
+def xpp_identity(xppname):
+    """
+    xppname - name of xpp as you call it from Terminal, or the list of arguments that start xpp
+
+    return:
+    the list describing the binary: arguments, resolved paths, sizes and modification times of the files among them.
+    It changes when xpp is upgraded.
+    """
+    cmd = xpp_command(xppname)
+    identity = []
+    for i, arg in enumerate(cmd):
+        filepath = find_executable(arg) if i == 0 else arg
+        if filepath is not None and os.path.isfile(filepath):
+            st = os.stat(filepath)
+            identity.append([arg, os.path.realpath(filepath), st.st_size, st.st_mtime])
         else:
+            identity.append([arg])
+    return identity
 
-            if mog in pnames:
-                # collect all inits into one explicit line
-                # this is where we convert from v[0..2]=1 syntax to v0=1,v1=1,v2=1 syntax.
-                #print mog
 
-                # remove list index brackets '[0,1,2]' -> '0,1,2'
-                listval = linits[mog][1:-1]
-                listval = listval.split(',')
+class ResultCache(object):
+    """
+    On-disk cache of results of xpprun, enable it by xpprun(..., cache=ResultCache(directory)).
+
+    A result is found by the hash of the ODE source, the parameters, the inits, the options of xpprun
+    and the identity of the xpp binary. out is stored as key.npy and vn as key.json in directory.
+    When the total size of .npy files exceeds max_bytes, the least recently used results are removed down to 90% of it.
+    The cache can be shared by several processes.
+    The directory is scanned when the cache is created and at every eviction. In between, the total size is
+    counted from the results stored through this object, so results of other processes are seen at the next eviction.
+
+    Ex.: fitting with fmin calls xpprun many times with the same parameters
+    cache = ResultCache('xpp_cache', max_bytes=2**30)
+    npa, vn = xpprun('hh.ode', parameters={'i':x[0]}, cache=cache, clean_after=True)
+    """
 
-                inits_new = ''
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory): # not created by another process
+                    raise
+        # xpp_identity looks for the binary in PATH, it is done once per xppname
+        self.identities = {}
+        self.lock = threading.Lock()
+        self.total = sum(size for mtime, size, key in self.entries())
+
+    def key(self, srclines, xppname, **options):
+        """
+        srclines - the content of the original ODE file
+        xppname - name of xpp or the list of arguments that start it
+        **options - anything else that changes the result: parameters, inits, version, etc.
 
-                
-                print mog,pnames,idxrange
-                for i in range(len(idxrange)):
-                    #print idxrange[i]
-                    inits_new += matchobj.group(1)+str(idxrange[i])+'='+listval[i]+','
+        return:
+        hex digest identifying the result
+        """
+        ident = repr(xppname)
+        if ident not in self.identities:
+            self.identities[ident] = xpp_identity(xppname)
+        h = hashlib.sha1(''.join(srclines).encode('utf-8'))
+        h.update(json.dumps([self.identities[ident], normalize_options(options)], sort_keys=True, default=str).encode('utf-8'))
+        return h.hexdigest()
 
-                # trim trailing comma
-                inits_new = inits_new[:-1]
-                inits_new = inits_new.replace(" ","")
+    def paths(self, key):
+        return os.path.join(self.directory, key+'.npy'), os.path.join(self.directory, key+'.json')
 
-                return inits_new
-                #return matchobj.group(1)+matchobj.group(2)+linits[mog]
-            else:
-                return matchobj.group(0)
+    def get(self, key):
+        """
+        return:
+        (out, vn) or None if there is no result for the key
+        """
+        npypath, jsonpath = self.paths(key)
+        try:
+            with open(jsonpath, 'r') as f:
+                vn = json.load(f)
+            out = np.load(npypath)
+            os.utime(npypath, None) # mark as recently used
+        except (IOError, OSError, ValueError):
+            return None
+        return out, vn
+
+    def put(self, key, out, vn):
+        """
+        stores (out, vn) under the key and evicts old results if the cache is too big
+        """
+        npypath, jsonpath = self.paths(key)
+        # write to temporary files and rename, a concurrent reader never sees a partial file
+        tmpid = '.%d.%s.tmp' % (os.getpid(), threading.current_thread().ident)
+        with open(jsonpath+tmpid, 'w') as f:
+            json.dump(vn, f)
+        with open(npypath+tmpid, 'wb') as f:
+            np.save(f, out)
+        try:
+            os.rename(jsonpath+tmpid, jsonpath)
+            os.rename(npypath+tmpid, npypath)
+            size = os.path.getsize(npypath)
+        except OSError: # on Windows rename fails if another process has stored the same result
+            for p in (jsonpath+tmpid, npypath+tmpid):
+                if os.path.isfile(p):
+                    os.remove(p)
+            return
+        # the directory is scanned only when the counted size exceeds max_bytes
+        with self.lock:
+            self.total += size
+            full = self.total > self.max_bytes
+        if full:
+            # 10% below the limit, so that the next stores do not scan the directory again at once
+            self.evict(int(self.max_bytes*.9))
+
+    def entries(self):
+        """
+        return:
+        the list of (modification time, size, key) of the .npy files in the directory
+        """
+        entries = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.npy'):
+                try:
+                    st = os.stat(os.path.join(self.directory, fname))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fname[:-4]))
+        return entries
+
+    def evict(self, max_bytes=None):
+        """
+        removes the least recently used results until the total size of .npy files is at most max_bytes,
+        self.max_bytes if None
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, key in entries)
+        for mtime, size, key in entries:
+            if total <= max_bytes:
+                break
+            for p in self.paths(key):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
+        with self.lock:
+            self.total = total
+
+    def clear(self):
+        """
+        removes all results
+        """
+        self.evict(-1)
 
 
-    # get lines of inits
-    i_par_lines = np.nonzero([re.search(init_re_sc1+'|'+\
-                                        init_re_sc2,line,flags=re.IGNORECASE) is not None for line in srclines])[0]
+def normalize_options(options):
+    """
+    options - the dict of keyword arguments of xpprun
+
+    return:
+    the same dict with the names of parameters and inits in low register, as xpp is not case sensitive
+    """
+    options = dict(options)
+    for k in ('parameters', 'inits'):
+        if options.get(k):
+            options[k] = {pn.lower():pv for pn, pv in options[k].items()}
+    if 'dtype' in options:
+        options['dtype'] = np.dtype(options['dtype']).str
+    return options
 
-    # get lines of array inits
-    i_ar_lines = np.nonzero([re.search(init_re_ar1+'|'+\
-                                       init_re_ar2,line,flags=re.IGNORECASE) is not None for line in srclines])[0]
-    #print i_ar_lines
 
-    # get line of 'done' flag. empty string if it does not exist.
-    i_d_line = np.nonzero([re.search('^ *(d)|^ *(done)',line,flags=re.IGNORECASE) is not None for line in srclines])[0]
+# the most precise clock available (time.perf_counter is not in python 2)
+clock = getattr(time, 'perf_counter', time.time)
 
-    # if the done flag position is empty, return -1
-    # else return the position number.
-    if i_d_line.size == 0:
-        i_d_line = -1
-    else:
-        i_d_line = i_d_line[0]
 
-    # mark which inits exist and which do not.
-    dnelist = 'init '
-    idx = 0
+class RunStats(object):
+    """
+    Timing of xpprun: wall time in seconds of its phases, the size of the output.
+    Pass an instance to xpprun(..., stats=stats) or xpprun_batch(..., stats=stats) to sum up runs.
+
+    Ex.: find out whether a sweep is bound by xppaut or by the output
+    stats = RunStats()
+    for i in np.linspace(0, 20, 100):
+        xpprun('hh.ode', parameters={'i':i}, clean_after=True, stats=stats)
+    print(stats)
+
+    Attributes:
+
+    parse - reading and parsing the .ode file
+    write - making the scratch directory and writing new .ode or initial conditions files
+    run - xppaut process from spawn to exit (or in-process integration of the numpy backend)
+    load - parsing the output file (or reading the result from the cache)
+    cleanup - storing to the cache and deleting the scratch directory
+    runs, failed, cached - the number of runs, failed runs and results taken from the cache
+    output_bytes, rows - the size of output files and the number of rows in them
+    """
+    phases = ('parse', 'write', 'run', 'load', 'cleanup')
+    counters = ('runs', 'failed', 'cached', 'output_bytes', 'rows')
+
+    def __init__(self):
+        for k in self.phases+self.counters:
+            setattr(self, k, 0)
 
-    # create list for deletion of state variable keys that do not exist
-    delete_keys = []
+    @property
+    def total(self):
+        return sum(getattr(self, k) for k in self.phases)
 
-    # cram all inits into one line, to make it easy to check if state variable exists
-    combinedlist = ''
-    
-    for i in range(len(i_par_lines)):
-        combinedlist += srclines[i_par_lines[i]]
-
-    # check if user-input initial conditions exist.
-    # iterate over user-input initial conditions
-    for k in inits:
-            
-        # if the user-input initial condition is not in the code...
-        # verify that this init is in fact a state variable
-        if not(k in combinedlist):
-            
-            vn = search_state_vars_in_srclines(srclines)
-            
-            if k in vn: # if state variable exists, take note that the init was not defined in the ode script
-                dnelist += k+'='+str(inits[k])
-            else:
-                # if the state variable does not exist in the ODE file, ignore.
-                delete_keys.append(k)
+    def add(self, other):
+        """
+        adds phases and counters of other RunStats to this one
+        """
+        for k in self.phases+self.counters:
+            setattr(self, k, getattr(self, k)+getattr(other, k))
+        return self
 
-    # delete the state variables that do not exist
-    for key in delete_keys:
-        del inits[key]
+    __iadd__ = add
 
-    # if there exist user-defined inits (not initialized in the script) that are existing state variables ...
-    if dnelist != 'init ':
-        # if new inits defined, move done flag to end
-        srclines[i_d_line] = ''
-        dnelist += '\n'
-        srclines.append(dnelist) # add the new inits
-        srclines.append('d')
-    #print srclines
+    def as_dict(self):
+        d = {k:getattr(self, k) for k in self.phases+self.counters}
+        d['total'] = self.total
+        return d
 
-    nsrclines=srclines[:]
-    for i in i_par_lines:
-        nsrclines[i] = re.sub('([a-z0-9_]+)( *\( *0 *\) *)?( *= *)([0-9\.e\-\+]+)', repl_in_par, nsrclines[i], flags=re.IGNORECASE)
+    def __repr__(self):
+        total = self.total or 1
+        times = ', '.join('%s %.4gs (%.0f%%)' % (k, getattr(self, k), 100.*getattr(self, k)/total) for k in self.phases)
+        return '<RunStats runs %d (failed %d, cached %d), %s, output %d bytes %d rows>' % (
+            self.runs, self.failed, self.cached, times, self.output_bytes, self.rows)
 
-    for i in i_ar_lines:
-        nsrclines[i] = re.sub('([a-z0-9_]+)\[([0-9]+..[0-9]+)\]( *\( *0 *\) *)?( *= *)([0-9\.e\-\+]+)', repl_in_ar, nsrclines[i], flags=re.IGNORECASE)
 
+def report_stats(stats, st, ret):
+    """
+    completes RunStats st of a run with the result ret and passes it to stats of xpprun
 
-    nsrc = ''.join(nsrclines)
-    with open(newfilepath, 'w') as f:
-        f.write(nsrc)
+    return:
+    ret
+    """
+    st.runs = 1
+    st.failed = int(ret is None)
+    if isinstance(stats, RunStats):
+        stats.add(st)
+    elif stats is not None:
+        stats(st)
+    return ret
 
 
-def check_if_in_ode(srclines,inits):
+class XppError(Exception):
     """
-    DEPRECATED 
-    
-    check whether a set of inits are listed in an ODE
-    return {dictonary of existing guys}, {dictionary of nonexisting guys}
+    xppaut has failed, has been killed after the timeout, or its output could not be read.
+    With xpprun(..., errors='raise') it is raised, with errors='return' it is returned instead of the Result.
+
+    Attributes:
+
+    cmd - the command of the run
+    returncode - the exit code of xppaut, None if it could not be started or has been killed
+    output - the tail of stdout and stderr of xppaut (str)
+    elapsed - wall time in seconds of the last attempt
+    timed_out - True if xppaut has been killed after the timeout
+    attempts - the number of times xppaut has been started
     """
-    i_par_lines = np.nonzero([re.search(init_re_sc1+'|'+\
-                                        init_re_sc2+'|'+\
-                                        init_re_ar1+'|'+\
-                                        init_re_ar2, line, flags=re.IGNORECASE) is not None for line in srclines])[0]
-    return i_par_lines
 
+    def __init__(self, message, cmd=None, returncode=None, output='', elapsed=0., timed_out=False, attempts=1):
+        Exception.__init__(self, message)
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.attempts = attempts
+
+    def __str__(self):
+        s = '%s (returncode %s, %.3gs, attempts %d)' % (self.args[0], self.returncode, self.elapsed, self.attempts)
+        return s+'\n'+self.output if self.output else s
+
+
+# the number of bytes of xpp output kept in XppError
+output_tail_bytes = 2000
 
+def output_tail(output):
+    if isinstance(output, bytes):
+        output = output[-output_tail_bytes:].decode('utf-8', 'replace')
+    return output[-output_tail_bytes:]
 
-def xpprun(filepath, version=8, xppname='xppaut', postfix='_tmp', parameters=None, inits=None, clean_after=False):
+
+def new_session_kwargs():
+    """
+    return:
+    keyword arguments of subprocess.Popen that start the process in a new process group,
+    so that xppaut and everything it has started can be killed at once
+    """
+    if os.name == 'posix':
+        if sys.version_info >= (3, 2):
+            return {'start_new_session': True}
+        return {'preexec_fn': os.setsid}
+    return {'creationflags': getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0)}
+
+
+def kill_process_group(proc):
+    """
+    kills the process started with new_session_kwargs and its children
+    """
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except OSError: # has already exited
+        pass
+
+
+def run_process(cmd, cwd=None, timeout=None):
+    """
+    Runs cmd in a new process group and waits for it at most timeout seconds, then kills the group.
+
+    return:
+    returncode (None if the process could not be started or has been killed), output (bytes), timed_out, elapsed time
+    """
+    tic = clock()
+    try:
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **new_session_kwargs())
+    except OSError as e:
+        return None, str(e).encode(), False, clock()-tic
+
+    expired = []
+    def expire():
+        expired.append(True)
+        kill_process_group(proc)
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+    try:
+        output, _ = proc.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if proc.returncode is None: # interrupted, xpp should not outlive the call
+            kill_process_group(proc)
+            proc.wait()
+    returncode = None if expired else proc.returncode
+    return returncode, output, bool(expired), clock()-tic
+
+
+class XppRun(object):
+    """
+    One call of xpprun split in steps, so that xppaut can be started in different ways
+    (subprocess in xpprun, asyncio in xppcall_async.xpprun_async):
+
+    run = XppRun(filepath, **options of xpprun) # parses the model, looks into the cache, writes the files of the run
+    if not run.done:     # the result is neither taken from the cache nor computed by the numpy backend
+        for attempt in range(1+run.retries):
+            ...          # start run.cmd in the folder run.cwd and wait for it at most run.timeout seconds
+            run.exited()
+            if run.succeeded(returncode, output, timed_out, elapsed, attempt):
+                break    # run.load() has read the output, or failed and recorded XppError in run.error
+    return run.finish()  # stores to the cache, cleans up, reports RunStats, returns Result, None or XppError
+    run.cancel() instead of run.finish() cleans up a run that is abandoned, without the errors policy
+    """
+
+    def __init__(self, filepath, version=8, xppname='xppaut', postfix='_tmp', parameters=None, inits=None, clean_after=False,
+                 tmpdir=None, dtype=np.float64, cache=None, backend='xpp', stats=None, variables=None, strip_aux=False,
+                 numerics=None, every=None, t_from=None, timeout=None, retries=0, errors='print', reducers=None, tail=None):
+        if errors not in ('print', 'ignore', 'raise', 'return'):
+            raise ValueError("errors should be 'print', 'ignore', 'raise' or 'return'")
+        if (tail is not None) and tail < 1:
+            raise ValueError('tail should be at least 1, got %r' % (tail,))
+        self.filepath = filepath
+        self.timeout = timeout
+        self.retries = retries
+        self.errors = errors
+        self.error = None
+        self.clean_after = clean_after
+        self.dtype = dtype
+        self.cache = cache
+        self.stats = stats
+        if (reducers is not None) and (variables is None) and (cache is None):
+            # only the columns the reducers look at are parsed.
+            # With cache the whole output is read, stored and reduced, the key is that of the run without reducers
+            variables = reducer_variables(reducers)
+        self.variables = variables
+        self.reducers = reducers
+        self.tail = tail
+        self.st = st = RunStats()
+        self.ret = None
+        self.whole = None # the Result of the whole output, for the cache
+        self.done = False
+        self.workdir = None
+        self.cmd = None
+
+        tic = clock()
+        self.model = model = load_model(filepath)
+        numerics = run_numerics(model, numerics, every=every, t_from=t_from)
+        if variables is not None:
+            self.usecols, self.vn, aux_lines = model.projection(variables, strip_aux=strip_aux and backend == 'xpp')
+        else:
+            self.usecols, self.vn, aux_lines = None, list(model.variables), []
+        st.parse, tic = clock()-tic, clock()
+
+        if cache is not None:
+            self.cachekey = cache.key(model.srclines, xppname, version=version, parameters=parameters, inits=inits, dtype=dtype,
+                                      backend=backend, variables=variables, strip_aux=strip_aux, numerics=numerics)
+            ret = cache.get(self.cachekey)
+            st.load, self.tic = clock()-tic, clock()
+            if ret is not None:
+                self.ret = self.postprocess(Result(*ret))
+                self.done = True
+                st.cached = 1
+                return
+
+        if backend == 'numpy':
+            import xppcall_numpy
+            out, vn = xppcall_numpy.xpprun_numpy(filepath, parameters=parameters, inits=inits, numerics=numerics, dtype=dtype)
+            if self.usecols is not None:
+                out = np.ascontiguousarray(out[:, self.usecols])
+            self.whole = Result(out, list(self.vn))
+            self.ret = self.postprocess(self.whole)
+            self.done = True
+            st.run, self.tic = clock()-tic, clock()
+            st.rows = out.shape[0]
+            return
+        elif backend != 'xpp':
+            raise ValueError("backend should be 'xpp' or 'numpy'")
+
+        # aux lines and numerics are changed in a copy, the model is shared
+        srclines = list(model.srclines)
+        path, filename = os.path.split(os.path.abspath(filepath))
+        name, ext = os.path.splitext(filename)
+        fullfilename = os.path.join(path, filename)
+        cmd = xpp_command(xppname)
+
+        for i in aux_lines:
+            srclines[i] = '\n'
+        # the content of the new .ode file (None to run the original one) and the initial conditions are made
+        # before the scratch directory, so that invalid inits raise ValueError without leaving it behind
+        newsrc = ''.join(srclines) if aux_lines else None
+        icvalues = None
+
+        if version < 8:
+            # legacy code. Adds compatibility to older xpp versions that do not have command line inputs
+            # forwards compatible for now
+
+            if numerics:
+                numerics_to_srclines(srclines, numerics, model.done_line)
+
+            if (parameters is not None) or (inits is not None) or numerics:
+                # parameters and inits go to the same file in one join
+                template = ode_template(srclines) if (numerics or aux_lines) else model.template
+                newsrc = template.render(parameters=parameters, inits=inits)
+
+        elif (inits is not None) and (inits != {}):
+            # the inits go to the file of initial conditions, the .ode file is not rewritten,
+            # unless the file of initial conditions cannot be relied on (see OdeModel.icfile_values)
+            icvalues = model.icfile_values(inits)
+            if icvalues is None:
+                newsrc = (ode_template(srclines) if aux_lines else model.template).render(inits=inits)
+
+        # in the temporary folder of the system by default, runs with clean_after=False do not pile up next to the model
+        self.workdir = workdir = tempfile.mkdtemp(prefix=name+postfix+'_', dir=tmpdir)
+        newfilepath = os.path.join(workdir, name+postfix+ext)
+        self.outputfilepath = outputfilepath = os.path.join(workdir, 'output.dat')
+
+        if newsrc is not None:
+            fullfilename = newfilepath # change to new file
+            with open(newfilepath, 'w') as f:
+                f.write(newsrc)
+
+        if version < 8:
+            cmd += [fullfilename, '-silent', '-outfile', outputfilepath]
+
+        else:
+            # if xpp version >= 8, run using command line inputs.
+
+            # clean inputs into cli compatible format
+            inputstr = ''
+
+            if (parameters is not None) and (parameters != {}):
+                # for each parameter, append to string
+                for opt in parameters:
+                    inputstr += opt+'='+str(parameters[opt])+';'
+
+            # numerical options go the same way
+            for opt in sorted(numerics):
+                inputstr += opt+'='+str(numerics[opt])+';'
+
+            # remove trailing semicolon
+            inputstr = inputstr[:-1]
+
+            cmd += [fullfilename, '-silent']
+            if inputstr != '':
+                cmd += ['-with', inputstr]
+
+            if icvalues is not None:
+                icfilepath = os.path.join(workdir, 'inits.ic')
+                model.write_icfile(icvalues, icfilepath)
+                cmd += ['-icfile', icfilepath]
+            cmd += ['-runnow', '-outfile', outputfilepath]
+
+        self.cmd = cmd
+        # xppaut is started in the folder of the .ode file, relative paths in the file are resolved as before
+        self.cwd = path
+        st.write, self.tic = clock()-tic, clock()
+
+    def postprocess(self, res):
+        """
+        res - Result of the whole run (from the cache or the numpy backend)
+
+        return:
+        res, its last rows if the run has tail, the dict of summaries if the run has reducers
+        """
+        if self.tail is not None:
+            res = Result(np.ascontiguousarray(res.out[-self.tail:]), res.vn)
+        return res if self.reducers is None else reduce_chunks(self.reducers, [res])
+
+    def exited(self):
+        """
+        to be called when the xppaut process has exited (every attempt)
+        """
+        self.st.run, self.tic = self.st.run+clock()-self.tic, clock()
+
+    def succeeded(self, returncode, output, timed_out, elapsed, attempt=0):
+        """
+        checks the exit of xppaut and loads the output
+
+        returncode, output, timed_out, elapsed - as returned by run_process
+        attempt - 0 for the first start of xppaut, 1 for the first retry etc.
+
+        return:
+        True if the run is over (the output is loaded, or it could not be read), False if xppaut has failed and may be retried
+        """
+        if timed_out or returncode != 0:
+            message = 'xpp has been killed after the timeout of %ss' % self.timeout if timed_out else 'xpp has failed'
+            self.fail(XppError(message, self.cmd, returncode, output_tail(output), elapsed, timed_out, attempt+1))
+            return False
+        try:
+            self.load()
+        except Exception as e:
+            self.fail(XppError('the output of xpp could not be read: %s' % e, self.cmd, returncode, output_tail(output),
+                               elapsed, False, attempt+1))
+        return True
+
+    def load(self):
+        """
+        reads the output file of xppaut into the Result
+        """
+        st = self.st
+        st.output_bytes = os.path.getsize(self.outputfilepath)
+        if self.tail is not None:
+            out = load_output_tail(self.outputfilepath, self.tail, dtype=self.dtype, usecols=self.usecols)
+            self.ret = Result(out, list(self.vn))
+            st.rows = out.shape[0]
+            if self.reducers is not None:
+                self.ret = reduce_chunks(self.reducers, [self.ret])
+        elif (self.reducers is not None) and (self.cache is None):
+            # the output is reduced while it is read, only the summaries are kept
+            rows = []
+            def chunks():
+                for chunk in iter_output_chunks(self.outputfilepath, dtype=self.dtype, usecols=self.usecols):
+                    rows.append(chunk.shape[0])
+                    yield Result(chunk, list(self.vn))
+            self.ret = reduce_chunks(self.reducers, chunks())
+            st.rows = sum(rows)
+        elif self.usecols is None:
+            # the file is read now (it may be deleted by clean_after), and parsed at the first use of the result.
+            # Its shape is checked now, so that a cut output is a failed run and not an error at the first use.
+            with open(self.outputfilepath, 'rb') as f:
+                data = f.read()
+            st.rows, ncols = output_shape(data)
+            if st.rows and ncols < 1+len(self.vn):
+                raise ValueError('%d columns in the output, %d variables in the model' % (ncols, len(self.vn)))
+            self.ret = Result(vn=list(self.vn), data=data, dtype=self.dtype)
+        else:
+            out = load_output(self.outputfilepath, dtype=self.dtype, usecols=self.usecols)
+            self.ret = Result(out, list(self.vn))
+            st.rows = out.shape[0]
+        if self.tail is None and isinstance(self.ret, Result):
+            # the whole output goes to the cache, the summaries are returned
+            self.whole = self.ret
+            if self.reducers is not None:
+                self.ret = reduce_chunks(self.reducers, [self.whole])
+        st.load, self.tic = st.load+clock()-self.tic, clock()
+
+    def fail(self, error):
+        """
+        to be called with XppError if xppaut has failed or its output could not be read
+        """
+        self.ret = None
+        self.whole = None
+        self.error = error
+        self.st.load, self.tic = self.st.load+clock()-self.tic, clock()
+
+    def finish(self):
+        """
+        stores the result to the cache, deletes the scratch directory if clean_after, reports RunStats
+
+        return:
+        Result, or if the run has failed: None (errors='print' or 'ignore'), XppError (errors='return'),
+        XppError is raised with errors='raise'
+        """
+        ret = self.cleanup()
+        if ret is None and self.error is not None:
+            if self.errors == 'raise':
+                raise self.error
+            if self.errors == 'return':
+                return self.error
+            if self.errors == 'print':
+                print('xpp was not called properly. check that xpp is installed and its alias.')
+                print(self.error)
+        return ret
+
+    def cancel(self):
+        """
+        to be called instead of finish if the run is abandoned (e.g. its task is cancelled):
+        deletes the scratch directory if clean_after and reports RunStats of a failed run, errors is not applied
+        """
+        self.ret = None
+        self.cleanup()
+
+    def cleanup(self):
+        """
+        stores the result to the cache, deletes the scratch directory if clean_after, reports RunStats
+
+        return:
+        the result of the run, None if it has failed
+        """
+        # the cache keeps whole outputs only
+        if (self.cache is not None) and (self.whole is not None) and not self.st.cached:
+            self.cache.put(self.cachekey, self.whole.out, self.whole.vn)
+
+        if self.clean_after and (self.workdir is not None):
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        self.st.cleanup = clock()-self.tic
+        return report_stats(self.stats, self.st, self.ret)
+
+
+def xpprun(filepath, version=8, xppname='xppaut', postfix='_tmp', parameters=None, inits=None, clean_after=False, tmpdir=None, dtype=np.float64, cache=None, backend='xpp', stats=None, variables=None, strip_aux=False,
+           numerics=None, every=None, t_from=None, timeout=None, retries=0, errors='print', reducers=None, tail=None):
     """
     A simple interface to xppaut. It runs xpp in a silent mode 'xpp some_ode_file.ode -silent'
     and analyses the result of computation, a file produced by xpp (output.dat by default).
@@ -461,127 +1845,695 @@ def xpprun(filepath, version=8, xppname='xppaut', postfix='_tmp', parameters=Non
     the value of x would be set to 10.1.
     If you pass the dict of parameters, then the new .ode will be created from your original .ode and xppaut will be run with it.
 
+    Every run gets its own scratch directory for the output file and the new .ode file,
+    and xppaut is started in the folder of the .ode file without changing the current directory of python.
+    Therefore xpprun can be called from several threads or processes at the same time.
+
     Input:
     
     filepath - path to ode file. Ex.: /home/user/xppfile.ode (Linux), D:/some_folder/xppfile.ode (Windows)
     version - xpp version number. If for example you are running xpp version 6.11, use version=6.
-    xppname - name of xpp as you call it from Terminal
+    xppname - name of xpp as you call it from Terminal, or the list of arguments that start xpp
     postfix - the postfix of new .ode file made out of original
     parameters - the dict of parameters to be modified
-    clean_after - if True temporary .ode file (with modified parameters) would be deleted after computations
-
-    Output: tuple (out, vn) or None
-
+    inits - the dict of initial conditions to be modified, e.g. {'v':-60} or {'u':[1,2,3]} for an array u[1..3].
+            With version>=8 they are passed to xpp in a file of initial conditions (-icfile), the .ode file is not rewritten,
+            unless the model has %[..] blocks or a name is not a state variable found in the file (see OdeModel.icfile_values).
+            A list for an array with an init line in the file is for the index range of that line.
+    clean_after - if True the scratch directory of the run (output file, .ode file with modified parameters) would be deleted after computations.
+                  If False, every run leaves its own directory <name><postfix>_XXXXXX in tmpdir.
+    tmpdir - the folder where scratch directories are created, the temporary folder of the system (tempfile.gettempdir()) by default
+    dtype - the type of numbers in out, np.float64 or np.float32 to halve the memory
+    cache - ResultCache. If given, the result of the same run is taken from the cache instead of running xpp.
+    backend - 'xpp' to run xppaut, or 'numpy' to integrate the model in python without xppaut (see xppcall_numpy.py).
+              The numpy backend supports scalar models such as hh.ode and simple.ode, and the methods euler, modeuler and rungekutta.
+    stats - RunStats to which the timing of this run is added, or a function called with the RunStats of this run
+    variables - the list of names of variables to return, e.g. ['v','m']. Other columns are dropped while the output is read,
+                out has the columns time and variables, and vn is variables. All variables if None.
+    strip_aux - if True (and variables is given), aux declarations of the variables not requested are removed
+                from a copy of the .ode file, so that xpp neither computes nor writes them
+    numerics - the dict of numerical options of the run, e.g. {'total':100, 'dt':.01, 'njmp':10, 'meth':'euler'}.
+               With version>=8 they are passed to xpp with '-with', the .ode file is not rewritten.
+    every - keep only every k-th time point: njmp is multiplied by every, xpp writes k times fewer rows
+    t_from - keep only the time points t >= t_from (the option trans), e.g. to drop a transient
+    timeout - the limit of wall time of xppaut in seconds. A stalled xppaut is killed with all processes it has started.
+    retries - the number of times xppaut is started again if it has failed or has been killed after the timeout
+    errors - what to do if the run has failed: 'print' the message and return None, 'ignore' and return None,
+             'raise' XppError or 'return' XppError instead of the Result.
+             XppError tells the exit code, the tail of the output of xppaut, the elapsed time and whether the timeout has expired.
+    reducers - the dict {name: Reducer}, e.g. {'spikes': Crossings('v', 0), 'vmax': Max('v'), 'final': Last()}.
+               The output is reduced while it is read in chunks and the dict {name: summary} is returned instead of Result.
+               Only the columns needed by the reducers are parsed (unless variables is given).
+               With cache, the whole output (of variables) is read, stored to the cache and reduced,
+               and results in the cache are reduced: runs with and without reducers share the cache.
+    tail - the number of last rows to return (at least 1), e.g. tail=1 for the final state: out[-1,1:].
+           The output file is read backwards from its end, the rest of it is not parsed.
+           With cache, results are taken from the cache, the tails are not stored.
+
+    Output: Result, None or XppError (see errors), the dict of summaries with reducers
+
+    Result unpacks as the tuple (out, vn):
     out - numpy.array where out[:,0] is time, and out[:,1:] is the matrix with solutions for model variables
     vn - the list with the names of variables that allow you to search for a data row in the matrix by a variable's name
     To plot variable with name NaCl in ode vs. time, run
     plt.plot(npa[:,0], npa[:, 1+vn.index('NaCl')])
+    or with res = xpprun(...)
+    plt.plot(res.t, res['nacl'])
+
+    """
 
+    run = XppRun(filepath, version=version, xppname=xppname, postfix=postfix, parameters=parameters, inits=inits,
+                 clean_after=clean_after, tmpdir=tmpdir, dtype=dtype, cache=cache, backend=backend, stats=stats,
+                 variables=variables, strip_aux=strip_aux, numerics=numerics, every=every, t_from=t_from,
+                 timeout=timeout, retries=retries, errors=errors, reducers=reducers, tail=tail)
+    if not run.done:
+        for attempt in range(1+retries):
+            returncode, output, timed_out, elapsed = run_process(run.cmd, cwd=run.cwd, timeout=timeout)
+            run.exited()
+            if run.succeeded(returncode, output, timed_out, elapsed, attempt):
+                break
+    return run.finish()
+
+
+def xpprun_segments(filepath, total, segment, inits=None, numerics=None, variables=None, **kwargs):
     """
+    Integrates the model from t0 to t0+total in segments of segment time units, one xppaut run per segment.
+    The last row of a segment is the initial condition of the next one, and every segment is yielded
+    as soon as it is computed, so the whole trajectory is never held in memory and the caller can stop early.
 
-    srclines = file_to_lines(filepath)
-    path, filename = os.path.split(filepath)
-    name, ext = os.path.splitext(filename)
-    wd = os.getcwd()
-    rndid=''; rndid2=''; newfilepath=''
+    Ex.: the maximum of v over a long run
+    vmax = -np.inf
+    for res in xpprun_segments('hh.ode', total=1e5, segment=1000, parameters={'i':10}):
+        vmax = max(vmax, res['v'].max())
 
+    Input:
 
+    filepath - path to ode file
+    total - the length of the whole run (as the option total of xpp)
+    segment - the length of one segment
+    inits - the dict of initial conditions of the first segment, as in xpprun
+    numerics - the dict of numerical options as in xpprun, t0 is the start of the first segment
+    variables - the list of names of variables to yield, all variables if None.
+                All state variables are read anyway, they are the initial conditions of the next segment.
+    **kwargs - keyword arguments of xpprun (parameters, xppname, every, errors, ...), clean_after is True by default
+
+    Output: generator of Result (out, vn), one per segment. The first row of a segment (the last row of the previous one)
+    is dropped, so the segments joined together are the trajectory of one long run.
+    The values are handed over with the precision of the output file of xppaut.
+    The generator stops if a run has failed (see errors of xpprun).
+    Models with %[..] blocks are not supported (ValueError).
+    """
+    if kwargs.get('reducers') is not None or kwargs.get('tail') is not None:
+        raise ValueError('xpprun_segments needs whole segments, reduce them in the loop instead of reducers or tail')
+    model = load_model(filepath)
+    if model.blocks:
+        # the variables of %[..] blocks are not known, the columns could not be handed over to the right inits
+        raise ValueError('xpprun_segments does not support %%[..] blocks, the state variables of %s are not known' % filepath)
+    numerics = {k.lower():v for k,v in (numerics or {}).items()}
+    kwargs.setdefault('clean_after', True)
+    # the transient is dropped here, every segment has to write its last row for the next one
+    t_from = kwargs.pop('t_from', None)
+    if 'trans' in numerics:
+        t_from = float(numerics.pop('trans'))
+    start = t = float(numerics.get('t0', model.numerics.get('t0', 0)))
+    end = start+total
+
+    nstate = len(model.state_vars)
+    if variables is not None:
+        vn = [v.lower() for v in variables]
+        readvars = list(model.state_vars)+[v for v in vn if v not in model.state_vars]
+        cols = [0]+[1+readvars.index(v) for v in vn]
+    else:
+        vn, readvars, cols = list(model.variables), None, None
+
+    first = True
+    while end-t > 1e-9*max(1., abs(end)):
+        numerics['t0'] = t
+        numerics['total'] = min(segment, end-t)
+        res = xpprun(filepath, inits=inits, numerics=numerics, variables=readvars, **kwargs)
+        if not isinstance(res, Result):
+            return
+        out = res.out
+        if out.shape[0] == 0:
+            raise ValueError('xpp has written no output from t=%g, check numerical options of the segments' % t)
+        if not first:
+            if out.shape[0] == 1: # the rest of the run is shorter than the output step
+                return
+            out = out[1:]
+        first = False
+        t = float(out[-1, 0])
+        inits = dict(zip(model.state_vars, out[-1, 1:1+nstate]))
+        if t_from is not None:
+            out = out[out[:, 0] >= t_from]
+            if out.shape[0] == 0:
+                continue
+        if cols is not None:
+            out = np.ascontiguousarray(out[:, cols])
+        yield Result(out, list(vn))
+
+def xpprun_star(args):
+    """
+    xpprun(*args) for pool.imap, which passes a single argument.
+    args - tuple (filepath, kwargs) or (filepath, kwargs, True) to return (result, RunStats of the run)
+    """
+    if len(args) == 3:
+        filepath, kwargs, with_stats = args
+        st = RunStats()
+        return xpprun(filepath, stats=st, **kwargs), st
+    filepath, kwargs = args
+    return xpprun(filepath, **kwargs)
 
-    if version < 8:
-        # legacy code. Adds compatibility to older xpp versions that do not have command line inputs
-        # forwards compatible for now
 
+def xpprun_batch(filepath, runs, workers=None, pool='thread', ordered=True, stats=None, ahead=None, **kwargs):
+    """
+    Runs xpprun for many sets of parameters/inits in parallel.
+    Each run is a separate xppaut process with its own output file, the runs are distributed over a pool of workers.
+
+    Ex.: scan the input current of hh.ode on all cores
+    runs = [{'parameters':{'i':i}} for i in np.linspace(0, 20, 100)]
+    for npa, vn in xpprun_batch('hh.ode', runs, clean_after=True):
+        plt.plot(npa[:,0], npa[:, 1+vn.index('v')])
+
+    Input:
+
+    filepath - path to ode file
+    runs - the list of dicts, e.g. [{'parameters':{'i':1.0}, 'inits':{'v':-60}}, ...].
+           Keys of a dict are keyword arguments of xpprun, they override the common **kwargs.
+    workers - the number of simultaneous xppaut processes, all cpus by default
+    pool - 'thread' (multiprocessing.pool.ThreadPool) or 'process' (multiprocessing.Pool).
+           Threads are enough since the work is done by xppaut subprocesses, results are not pickled
+           and lambdas (e.g. in Fold reducers) can be used.
+           With pool='process', where new processes are spawned (Windows, macOS), call xpprun_batch
+           only under if __name__ == '__main__':
+    ordered - if True results are yielded in the order of runs, as soon as they are available,
+              if False tuples (index of run, result) are yielded in the order of completion
+    ahead - if given, a run is started only if it is less than ahead runs after the first run whose result
+            has not been yielded yet. The results that have finished before a slow run are then at most ahead
+            (in the pool with ordered=True, in the reorder buffer of the caller with ordered=False).
+            It should be a few times workers, so that the workers are not idle while a slow run is waited for.
+            All runs are started as soon as a worker is free by default.
+    stats - RunStats to which the timing of all runs is added, or a function called with the RunStats of every run.
+            With backend='numpy' every run gets an equal share of the time of the batch.
+    **kwargs - keyword arguments of xpprun common to all runs.
+               With backend='numpy' all runs are integrated at once as one batch in this process,
+               only 'parameters' and 'inits' of runs are taken into account.
+
+    Output: generator of results of xpprun, Result (out, vn) or None (XppError with errors='return') for each run,
+    the dicts of summaries with reducers=...
+    Use list(xpprun_batch(...)) to collect all of them.
 
-        if (parameters is not None) or (inits is not None):
-            rndid='_rndid'+str(int(random()*1e15))
-            filename = name+postfix+rndid+ext # change to new file
-            newfilepath = os.path.join(path, filename)
-            fullfilename = os.path.join(path, filename)
-            if parameters is not None:
-                change_parameters_in_ode_and_save(srclines, parameters, newfilepath)
-            if inits is not None:
-                change_inits_in_ode_and_save(srclines, inits, newfilepath)
+    """
+    if kwargs.get('backend') == 'numpy':
+        import xppcall_numpy
+        if (kwargs.get('tail') is not None) and kwargs['tail'] < 1:
+            raise ValueError('tail should be at least 1, got %r' % (kwargs['tail'],))
+        tic = clock()
+        model = load_model(filepath)
+        numerics = run_numerics(model, kwargs.get('numerics'), every=kwargs.get('every'), t_from=kwargs.get('t_from'))
+        if kwargs.get('variables') is not None:
+            usecols, vn, aux_lines = model.projection(kwargs['variables'])
+        parse, tic = clock()-tic, clock()
+        results = list(xppcall_numpy.xpprun_batch_numpy(filepath, runs, numerics=numerics, dtype=kwargs.get('dtype', np.float64)))
+        integrate, tic = clock()-tic, clock()
+        for i, res in enumerate(results):
+            # the runs are integrated at once, every run gets its share of the time
+            st = RunStats()
+            st.parse = parse/len(results)
+            st.run = integrate/len(results)
+            st.rows = res.out.shape[0]
+            if kwargs.get('variables') is not None:
+                res = Result(np.ascontiguousarray(res.out[:, usecols]), list(vn))
+            if kwargs.get('tail') is not None:
+                res = Result(np.ascontiguousarray(res.out[-kwargs['tail']:]), res.vn)
+            if kwargs.get('reducers') is not None:
+                res = reduce_chunks(kwargs['reducers'], [res])
+            st.load, tic = clock()-tic, clock()
+            res = report_stats(stats, st, res)
+            yield res if ordered else (i, res)
+        return
+
+    tasks = []
+    for run in runs:
+        kw = dict(kwargs)
+        kw.update(run)
+        # RunStats of a run is sent back from the worker and reported here
+        tasks.append((filepath, kw) if stats is None else (filepath, kw, True))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(tasks)))
+
+    if pool == 'process':
+        p = multiprocessing.Pool(workers)
+    elif pool == 'thread':
+        p = ThreadPool(workers)
+    else:
+        raise ValueError("pool should be 'process' or 'thread'")
+
+    # the first run whose result has not been yielded, the indices of the yielded runs after it
+    window = threading.Condition()
+    state = {'first': 0, 'stop': False}
+    yielded = set()
+
+    def feed(items):
+        # the tasks are taken by the task handler thread of the pool, it waits here until the run is within ahead
+        for i, item in enumerate(items):
+            if ahead is not None:
+                with window:
+                    while i >= state['first']+ahead and not state['stop']:
+                        window.wait()
+                    if state['stop']:
+                        return
+            yield item
+
+    def done(i):
+        if ahead is not None:
+            with window:
+                yielded.add(i)
+                while state['first'] in yielded:
+                    yielded.remove(state['first'])
+                    state['first'] += 1
+                window.notify_all()
+
+    try:
+        if ordered:
+            for i, res in enumerate(p.imap(xpprun_star, feed(tasks), 1)):
+                if stats is not None:
+                    res = report_batch_stats(stats, *res)
+                done(i)
+                yield res
         else:
-            fullfilename = os.path.join(path, filename)
-        
-        if path!='':
-            os.chdir(path)
-        outputfile = 'output%s.dat'%(rndid+rndid2)
-        outputfilepath = os.path.join(path, outputfile)
+            for i, res in p.imap_unordered(xpprun_star_indexed, feed(enumerate(tasks)), 1):
+                if stats is not None:
+                    res = report_batch_stats(stats, *res)
+                done(i)
+                yield i, res
+        p.close()
+    finally:
+        # releases the task handler if it waits in feed, stops the remaining runs if the generator was not exhausted
+        with window:
+            state['stop'] = True
+            window.notify_all()
+        p.terminate()
+        p.join()
+
+
+def report_batch_stats(stats, ret, st):
+    if isinstance(stats, RunStats):
+        stats.add(st)
+    else:
+        stats(st)
+    return ret
 
-        try:
-            res = subprocess.check_output("%s %s -silent -outfile %s" % (xppname, fullfilename, outputfilepath), stderr=subprocess.STDOUT, shell=True)
-            os.chdir(wd)
 
-            out = np.genfromtxt(outputfilepath, delimiter=' ')
+def xpprun_star_indexed(args):
+    """
+    Same as xpprun_star, but takes and returns the index of a run: (i, (filepath, kwargs)) -> (i, result)
+    """
+    i, task = args
+    return i, xpprun_star(task)
 
 
-            vn = search_state_vars_in_srclines(srclines)
-            ret = out, vn
+def evaluate_points(filepath, names, points, measure, **kwargs):
+    """
+    Runs the model at points in the space of parameters with xpprun_batch and measures every run:
+    the value of a point for optimizers, sensitivity analyses and adaptive sweeps.
 
-        except:
+    Ex.: the maximum of v for two values of i
+    evaluate_points('hh.ode', ['i'], [[5.], [10.]], Max('v'), clean_after=True)
 
-            ret = None
+    Input:
 
+    filepath - path to ode file
+    names - the list of names of parameters, the order of values of a point
+    points - the sequence of points, each one a sequence of values of names
+    measure - a function of Result returning the value of a run (its errors are raised),
+              or a Reducer whose summary is the value (computed while the output is read)
+    **kwargs - keyword arguments of xpprun_batch and xpprun (workers, pool, xppname, clean_after, ...).
+               parameters are the values of the parameters not in names, errors is 'ignore' by default.
+               reducers cannot be given if measure is a Reducer.
 
-        
-    else:
-        # if xpp version >= 8, run using command line inputs.
-
-        # clean inputs into cli compatible format
-        inputstr = ''
-
-        if (parameters is not None) and (parameters != {}):
-            # for each parameter, append to string
-            for opt in parameters:
-                inputstr += opt+'='+str(parameters[opt])+';'
-
-        # remove trailing semicolon
-        inputstr = inputstr[:-1]
-
-        if (inits is not None) and (inits != {}):
-            # for each input, append to string
-            rndid='_rndid'+str(int(random()*1e15))
-            filename = name+postfix+rndid+ext # change to new file
-            newfilepath = os.path.join(path, filename)
-            fullfilename = os.path.join(path, filename)
-            change_inits_in_ode_and_save(srclines, inits, newfilepath)
+    Output: the list of values in the order of points, None for failed runs. numpy scalars become python numbers.
+    """
+    kwargs = dict(kwargs)
+    fixed = dict(kwargs.pop('parameters', None) or {})
+    kwargs.setdefault('errors', 'ignore')
+    if isinstance(measure, Reducer):
+        if kwargs.get('reducers') is not None:
+            raise ValueError('reducers cannot be given with a Reducer as the measure of runs')
+        kwargs['reducers'] = {'value': measure}
+    runs = []
+    for point in points:
+        parameters = dict(fixed)
+        parameters.update(zip(names, point))
+        runs.append({'parameters': parameters})
+    values = [None]*len(runs)
+    if not runs:
+        return values
+    for i, res in xpprun_batch(filepath, runs, ordered=False, **kwargs):
+        if isinstance(measure, Reducer):
+            value = res['value'] if isinstance(res, dict) else None
+        elif isinstance(res, Result):
+            value = measure(res)
         else:
-            fullfilename = os.path.join(path, filename)
+            value = None
+        values[i] = value.item() if isinstance(value, np.generic) else value
+    return values
 
-        
-        outputfile = 'output.dat'
-        outputfilepath = os.path.join(path, outputfile)
 
-        try:
+def json_default(obj):
+    """
+    default of json.dump for numpy numbers and arrays
+    """
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
 
-            res = subprocess.check_output("%s %s -silent -with '%s' -runnow -outfile %s" % (xppname, fullfilename, inputstr,outputfilepath), stderr=subprocess.STDOUT, shell=True)
 
+class SweepStore(object):
+    """
+    Results of a sweep in one memory-mapped array of shape (number of runs, number of time points, 1+number of variables),
+    stored in a .npy file, so that sweeps larger than RAM are written straight to disk and opened without copying.
+    Next to it: path.rows.npy - the number of rows written for every run (-1 if not written),
+    path.json - vn and the list of runs (their parameters and inits).
+    Only the first rows[i] time points of run i are valid, the rest of the array is not written
+    (zeros in a new file), so creating a store does not touch the pages of the whole file.
+
+    Ex.:
+    store = xpprun_sweep('wc.ode', runs, 'sweep.npy', workers=8, clean_after=True)
+    store = SweepStore.open('sweep.npy') # later, read-only
+    u = store.data[:, :, 1+store.vn.index('u0')] # u0 of all runs
+    out = store.data[i, :store.rows[i]]          # the output of run i
+
+    Attributes:
+
+    path - path to the .npy file
+    data - numpy.memmap of shape (runs, time points, 1+variables)
+    rows - numpy.memmap of the number of rows of every run, -1 if the run is not written (failed)
+    vn - the list of names of variables
+    runs - the list of runs
+    """
 
-            os.chdir(wd)
+    def __init__(self, path, data, rows, vn, runs):
+        self.path = path
+        self.data = data
+        self.rows = rows
+        self.vn = vn
+        self.runs = runs
 
-            out = np.genfromtxt(outputfilepath, delimiter=' ')
+    @staticmethod
+    def sidecar_paths(path):
+        base = os.path.splitext(path)[0]
+        return base+'.rows.npy', base+'.json'
 
+    @classmethod
+    def create(cls, path, n_runs, n_steps, vn, runs=None, dtype=np.float64):
+        """
+        creates the files of a store, no run is written
+        """
+        rowspath, jsonpath = cls.sidecar_paths(path)
+        data = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n_runs, n_steps, 1+len(vn)))
+        rows = np.lib.format.open_memmap(rowspath, mode='w+', dtype=np.int64, shape=(n_runs,))
+        rows[:] = -1
+        runs = list(runs) if runs is not None else [None]*n_runs
+        with open(jsonpath, 'w') as f:
+            json.dump({'vn': list(vn), 'runs': runs}, f, default=json_default)
+        return cls(path, data, rows, list(vn), runs)
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """
+        opens a store, mode 'r' (read-only) or 'r+'
+        """
+        rowspath, jsonpath = cls.sidecar_paths(path)
+        with open(jsonpath, 'r') as f:
+            meta = json.load(f)
+        data = np.load(path, mmap_mode=mode)
+        rows = np.load(rowspath, mmap_mode=mode)
+        return cls(path, data, rows, meta['vn'], meta['runs'])
+
+    def write(self, i, out):
+        """
+        writes out of run i, raises ValueError if it has more rows than the time points of the store
+        """
+        n = out.shape[0]
+        if n > self.data.shape[1]:
+            raise ValueError('run %d has %d time points, the store only %d' % (i, n, self.data.shape[1]))
+        self.data[i, :n] = out
+        self.rows[i] = n
 
-            vn = search_state_vars_in_srclines(srclines)
+    def flush(self):
+        self.data.flush()
+        self.rows.flush()
 
 
-            ret = out, vn
+def xpprun_sweep(filepath, runs, path, n_steps=None, dtype=np.float64, flush_every=100, **kwargs):
+    """
+    Runs xpprun_batch and writes every result to a SweepStore as soon as it is ready,
+    the results are not kept in memory.
+
+    filepath - path to ode file
+    runs - the list of dicts of keyword arguments of xpprun, as in xpprun_batch
+    path - path to the .npy file of the store
+    n_steps - the number of time points to store per run. By default the largest number of time points of the runs,
+              computed from the numerical options of the file and of the runs (total, dt, njmp, t0, trans, every, t_from, tail)
+    dtype - np.float64 or np.float32
+    flush_every - the store is flushed to disk every flush_every runs
+    **kwargs - keyword arguments of xpprun_batch and xpprun, e.g. workers=8, clean_after=True
+
+    Output: SweepStore opened read-only. Failed runs have rows -1.
+    A run with more time points than n_steps raises ValueError.
+    """
+    runs = list(runs)
+    if n_steps is None:
+        model = load_model(filepath)
+        n_steps = 0
+        for run in runs:
+            kw = dict(kwargs)
+            kw.update(run)
+            rows = output_rows(model, run_numerics(model, kw.get('numerics'), every=kw.get('every'), t_from=kw.get('t_from')))
+            if kw.get('tail') is not None:
+                rows = min(rows, kw['tail'])
+            n_steps = max(n_steps, rows)
+    kwargs['ordered'] = False
+    store = None
+    for count, (i, res) in enumerate(xpprun_batch(filepath, runs, dtype=dtype, **kwargs)):
+        if not isinstance(res, Result):
+            continue
+        out, vn = res
+        if store is None:
+            store = SweepStore.create(path, len(runs), n_steps, vn, runs, dtype=dtype)
+        store.write(i, out)
+        if (count+1) % flush_every == 0:
+            store.flush()
+    if store is None:
+        raise ValueError('all runs of the sweep have failed')
+    store.flush()
+    del store
+    return SweepStore.open(path)
+
+
+# options of xpprun that do not change the result of a run, they are not part of its key in RunLedger
+ledger_ignored_options = ('workers', 'pool', 'ordered', 'stats', 'clean_after', 'tmpdir', 'postfix', 'cache',
+                          'timeout', 'retries', 'errors')
+
+
+def describe_option(obj):
+    """
+    default of json.dumps for the keys of runs: reducers by their repr, functions by their names, numpy values as lists
+    """
+    if isinstance(obj, Fold):
+        return ['Fold', describe_option(obj.func), obj.initial]
+    if isinstance(obj, Reducer):
+        return repr(obj)
+    if callable(obj) and hasattr(obj, '__name__'):
+        return '%s.%s' % (getattr(obj, '__module__', None), obj.__name__)
+    return json_default(obj)
 
 
-            
-        except:
-            print 'xpp was not called properly. check that xpp is installed and its alias.'
-            ret = None
+class RunLedger(object):
+    """
+    An append-only log of the finished runs of a sweep, directory/ledger.jsonl, one JSON record per line:
+    {"key": ..., "status": "done" or "failed", "path": ..., "vn": ..., "summary": ..., "error": ...}.
+    It lets xpprun_resumable continue a sweep that has been interrupted (killed job, preempted node).
+
+    A run is identified by its key (run_key): the hash of the ODE source and of the options that change its result,
+    so the same run in another order or in another list of runs is found too.
+    out of a Result is saved to directory/results/key.npy before the record is written, vn is in the record,
+    the summaries of reducers are in the record itself (numpy.arrays become lists).
+    The last record of a key wins. A line cut by a crash is ignored, a record of a result whose file is missing does not count.
+
+    Ex.:
+    ledger = xpprun_resumable('hh.ode', runs, 'hh_sweep', workers=8, clean_after=True)
+    print(ledger.counts())
+    npa, vn = ledger[0] # the result of runs[0]
+
+    Attributes:
+
+    directory - the directory of the ledger and the results
+    path - path to ledger.jsonl
+    records - the dict {key: the last record}
+    keys - the keys of the runs of the last xpprun_resumable, in the order of runs
+    """
 
-    if clean_after:
-        if os.path.isfile(outputfilepath):
-            os.remove(outputfilepath)
-        if newfilepath!='':
-            os.remove(newfilepath)
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'ledger.jsonl')
+        self.records = {}
+        self.keys = []
+        self.f = None
+        resultsdir = os.path.join(directory, 'results')
+        if not os.path.isdir(resultsdir):
+            os.makedirs(resultsdir)
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError: # the line being written when the sweep was killed
+                        continue
+                    self.records[record['key']] = record
+
+    @staticmethod
+    def run_key(srclines, options):
+        """
+        srclines - the content of the ODE file
+        options - the dict of keyword arguments of xpprun of the run
 
+        return:
+        hex digest identifying the run. Functions are identified by their names (all lambdas of a module are the same).
+        """
+        options = normalize_options(dict((k, v) for k, v in options.items() if k not in ledger_ignored_options))
+        h = hashlib.sha1(''.join(srclines).encode('utf-8'))
+        h.update(json.dumps(options, sort_keys=True, default=describe_option).encode('utf-8'))
+        return h.hexdigest()
+
+    def status(self, key):
+        """
+        return:
+        'done', 'failed' or None if the run has not finished
+        """
+        record = self.records.get(key)
+        if record is None:
+            return None
+        if record['status'] == 'done' and 'path' in record and not os.path.isfile(os.path.join(self.directory, record['path'])):
+            return None
+        return record['status']
+
+    def append(self, record):
+        """
+        writes the record to the end of the ledger and to the disk
+        """
+        if self.f is None:
+            torn = False
+            if os.path.isfile(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    torn = f.read(1) != b'\n'
+            self.f = open(self.path, 'a')
+            if torn: # the rest of a line cut by a crash, the new records start on a new line
+                self.f.write('\n')
+        self.f.write(json.dumps(record, default=json_default)+'\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.records[record['key']] = record
+
+    def record(self, key, res):
+        """
+        records the result of the run key: Result, the dict of summaries, or anything else (None, XppError) for a failed run
+        """
+        if isinstance(res, Result):
+            relpath = os.path.join('results', key+'.npy')
+            path = os.path.join(self.directory, relpath)
+            tmppath = path+'.%d.tmp' % os.getpid()
+            with open(tmppath, 'wb') as f:
+                np.save(f, res.out)
+            if os.path.isfile(path): # a rerun, rename does not replace files on Windows
+                os.remove(path)
+            os.rename(tmppath, path)
+            record = {'key': key, 'status': 'done', 'path': relpath, 'vn': list(res.vn)}
+        elif isinstance(res, dict):
+            record = {'key': key, 'status': 'done', 'summary': res}
+        else:
+            record = {'key': key, 'status': 'failed'}
+            if isinstance(res, XppError):
+                record['error'] = str(res)
+                record['timed_out'] = res.timed_out
+        self.append(record)
+
+    def result(self, key):
+        """
+        return:
+        Result, the dict of summaries, or None if the run has failed or has not finished
+        """
+        if self.status(key) != 'done':
+            return None
+        record = self.records[key]
+        if 'summary' in record:
+            return record['summary']
+        return Result(np.load(os.path.join(self.directory, record['path'])), record['vn'])
+
+    def __getitem__(self, i):
+        return self.result(self.keys[i])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def counts(self):
+        """
+        return:
+        the dict of the numbers of runs of keys that are done, failed and missing (not finished)
+        """
+        counts = {'done': 0, 'failed': 0, 'missing': 0}
+        for key in self.keys:
+            counts[self.status(key) or 'missing'] += 1
+        return counts
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def xpprun_resumable(filepath, runs, directory, rerun_failed=True, **kwargs):
+    """
+    Runs xpprun_batch and records every finished run in the RunLedger of directory as soon as it is ready.
+    If the sweep is interrupted, call it again with the same arguments: the runs done are skipped,
+    the failed (if rerun_failed) and the missing ones are run. Identical runs are run once.
+
+    filepath - path to ode file
+    runs - the list of dicts of keyword arguments of xpprun, as in xpprun_batch
+    directory - the directory of the ledger and of the results, created if needed
+    rerun_failed - if False, the runs that have failed are not run again
+    **kwargs - keyword arguments of xpprun_batch and xpprun, e.g. workers=8, clean_after=True, timeout=60, reducers=...
+               errors='return' by default, so that the messages of failed runs are recorded
+
+    Output: RunLedger, ledger[i] is the result of runs[i] (Result, the dict of summaries, or None), loaded from disk
+    """
+    runs = list(runs)
+    kwargs['ordered'] = False
+    kwargs.setdefault('errors', 'return')
+    srclines = load_model(filepath).srclines
+    ledger = RunLedger(directory)
+    todo = []; seen = set()
+    for run in runs:
+        kw = dict(kwargs)
+        kw.update(run)
+        key = RunLedger.run_key(srclines, kw)
+        ledger.keys.append(key)
+        status = ledger.status(key)
+        if status == 'done' or (status == 'failed' and not rerun_failed) or key in seen:
+            continue
+        seen.add(key)
+        todo.append((key, run))
+    try:
+        if todo:
+            for i, res in xpprun_batch(filepath, [run for key, run in todo], **kwargs):
+                ledger.record(todo[i][0], res)
+    finally:
+        ledger.close()
+    return ledger
 
-    return ret
 
 read_pars = read_pars_values_from_file
 read_inits = read_init_values_from_file
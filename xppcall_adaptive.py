@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# (ɔ) Py_XPPCALL - a python binding to amazing XPPAUT
+#
+#     Copyright 2015 Ilya Prokin
+#     https://sites.google.com/site/ilyaprokin/
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Adaptive sweeps of parameters: the parameter space is mapped by the class of the behaviour of the model
+(e.g. spiking or resting), and samples are added only where the class changes.
+
+The sweep starts with a coarse grid of initial points per parameter. Every cell of the grid whose corners
+are not all of the same class is split in halves along every parameter, the new corners are run
+(all cells of a level in one parallel batch), and so on depth times.
+The boundaries between classes are resolved as finely as a uniform grid of (initial-1)*2**depth+1 points
+per parameter, with runs spent only near the boundaries.
+
+Ex.: where does hh.ode start to spike?
+sweep = adaptive_sweep('hh.ode', {'i': (0., 20.), 'gk': (20., 50.)}, lambda res: res['v'].max() > 0,
+                       initial=5, depth=5, clean_after=True)
+plt.scatter(sweep.points[:,1], sweep.points[:,0], c=sweep.labels)
+print(sweep.runs, sweep.grid_runs)
+"""
+
+import itertools
+
+import numpy as np
+
+from xppcall import evaluate_points
+
+
+class AdaptiveSweep(object):
+    """
+    The result of adaptive_sweep.
+
+    Attributes:
+
+    names - the list of names of parameters, the order of columns of points
+    points - numpy.array of values of parameters of all runs, one row per run
+    labels - the list of classes of the runs, None for failed runs
+    runs - the number of runs
+    grid_runs - the number of runs of the uniform grid of the same resolution
+    """
+
+    def __init__(self, names, points, labels, grid_runs):
+        self.names = names
+        self.points = points
+        self.labels = labels
+        self.runs = len(labels)
+        self.grid_runs = grid_runs
+
+    def __repr__(self):
+        return '<AdaptiveSweep of %s, %d runs (%d on the grid), classes %s>' % (
+            ', '.join(self.names), self.runs, self.grid_runs, ', '.join(sorted(set(repr(l) for l in self.labels))))
+
+
+def adaptive_sweep(filepath, ranges, classify, initial=5, depth=4, **kwargs):
+    """
+    filepath - path to ode file
+    ranges - the dict {name: (low, high)} of the parameters to sweep
+    classify - a function of Result returning the class of the run (a hashable value, e.g. True/False or an int),
+               or a Reducer of xppcall whose summary is the class (computed while the output is read)
+    initial - the number of points per parameter of the initial grid (at least 2)
+    depth - the number of refinements
+    **kwargs - keyword arguments of evaluate_points, xpprun_batch and xpprun (workers, pool, xppname, clean_after, ...).
+               parameters are the values of the parameters not swept, reducers cannot be given with a Reducer classify.
+
+    Output: AdaptiveSweep
+    """
+    if initial < 2:
+        raise ValueError('initial should be at least 2')
+    names = sorted(ranges)
+    k = len(names)
+    lo = np.array([ranges[name][0] for name in names], dtype=float)
+    hi = np.array([ranges[name][1] for name in names], dtype=float)
+    # points are on the lattice of the finest level, n steps per parameter
+    size = 2**depth
+    n = (initial-1)*size
+
+    labels = {}
+    order = []
+    cells = [tuple(size*c for c in corner) for corner in itertools.product(range(initial-1), repeat=k)]
+    while cells:
+        corners = []
+        for cell in cells:
+            for offset in itertools.product((0, size), repeat=k):
+                idx = tuple(c+o for c, o in zip(cell, offset))
+                if idx not in labels:
+                    labels[idx] = None
+                    corners.append(idx)
+
+        points = [(lo+(hi-lo)*np.array(idx)/n).tolist() for idx in corners]
+        labels.update(zip(corners, evaluate_points(filepath, names, points, classify, **kwargs)))
+        order += corners
+
+        if size == 1:
+            break
+        half = size//2
+        refined = []
+        for cell in cells:
+            classes = set(labels[tuple(c+o for c, o in zip(cell, offset))] for offset in itertools.product((0, size), repeat=k))
+            if len(classes) > 1:
+                refined += [tuple(c+o for c, o in zip(cell, offset)) for offset in itertools.product((0, half), repeat=k)]
+        cells = refined
+        size = half
+
+    points = lo+(hi-lo)*np.array(order, dtype=float).reshape(-1, k)/n
+    return AdaptiveSweep(names, points, [labels[idx] for idx in order], (n+1)**k)
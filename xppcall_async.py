@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# (ɔ) Py_XPPCALL - a python binding to amazing XPPAUT
+#
+#     Copyright 2015 Ilya Prokin
+#     https://sites.google.com/site/ilyaprokin/
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+asyncio interface of Py_XPPCALL (python 3.5+).
+
+xppaut is started with asyncio.create_subprocess_exec and awaited, so thousands of runs
+can be driven from an event loop without blocking a thread per run.
+
+Ex.:
+import asyncio
+from xppcall_async import xpprun_async, gather_runs
+
+async def main():
+    res = await xpprun_async('hh.ode', parameters={'i':10.}, clean_after=True)
+    runs = [{'parameters':{'i':i}} for i in range(100)]
+    results = await gather_runs('hh.ode', runs, limit=8, clean_after=True)
+
+asyncio.get_event_loop().run_until_complete(main())
+"""
+
+import asyncio
+import functools
+
+from xppcall import XppRun, xpprun, clock, new_session_kwargs, kill_process_group
+
+
+async def xpprun_async(filepath, **kwargs):
+    """
+    The same as xpprun(filepath, **kwargs), but awaits xppaut instead of blocking.
+    With backend='numpy' the model is integrated by xpprun in the default executor of the loop.
+    If the task is cancelled or the timeout has expired, xppaut is killed with all processes it has started.
+
+    Output: Result, None or XppError, as in xpprun
+    """
+    if kwargs.get('backend') == 'numpy':
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(xpprun, filepath, **kwargs))
+
+    run = XppRun(filepath, **kwargs)
+    if not run.done:
+        try:
+            for attempt in range(1+run.retries):
+                returncode, output, timed_out, elapsed = await run_process_async(run.cmd, run.cwd, run.timeout)
+                run.exited()
+                if run.succeeded(returncode, output, timed_out, elapsed, attempt):
+                    break
+        except asyncio.CancelledError:
+            # the scratch directory is cleaned up, the cancellation is not turned into an error of the run
+            run.cancel()
+            raise
+    return run.finish()
+
+
+async def run_process_async(cmd, cwd=None, timeout=None):
+    """
+    The same as xppcall.run_process, awaits the process.
+    If the task is cancelled, the process group is killed and CancelledError is raised.
+    """
+    tic = clock()
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.STDOUT, **new_session_kwargs())
+    except OSError as e:
+        return None, str(e).encode(), False, clock()-tic
+    try:
+        output, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        kill_process_group(proc)
+        await proc.wait()
+        return None, b'', True, clock()-tic
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            kill_process_group(proc)
+            await proc.wait()
+        raise
+    return proc.returncode, output, False, clock()-tic
+
+
+async def gather_runs(filepath, runs, limit=8, **kwargs):
+    """
+    Runs xpprun_async for many sets of parameters/inits, at most limit xppaut processes at a time.
+
+    filepath - path to ode file
+    runs - the list of dicts of keyword arguments of xpprun, as in xpprun_batch
+    limit - the maximal number of simultaneous runs
+    **kwargs - keyword arguments of xpprun common to all runs
+
+    Output: the list of results in the order of runs
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def one(run):
+        kw = dict(kwargs)
+        kw.update(run)
+        async with semaphore:
+            return await xpprun_async(filepath, **kw)
+
+    return await asyncio.gather(*[one(run) for run in runs])
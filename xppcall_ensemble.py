@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+# (ɔ) Py_XPPCALL - a python binding to amazing XPPAUT
+#
+#     Copyright 2015 Ilya Prokin
+#     https://sites.google.com/site/ilyaprokin/
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Ensemble mode of xpprun: many runs of one model in a single xppaut process.
+
+The model is replicated N times in one ODE file with the array syntax of xpp:
+every state variable v becomes v_[1..N], a swept parameter p becomes the parameters p_1, ..., p_N,
+and the initial conditions of every copy are given with init lines.
+xppaut is started once and its output is split back into N results,
+so the cost of starting xppaut is paid once for hundreds of small runs.
+
+Ex.:
+from xppcall_ensemble import xpprun_ensemble
+runs = [{'parameters':{'i':i}} for i in np.linspace(0, 20, 200)]
+for npa, vn in xpprun_ensemble('hh.ode', runs, clean_after=True):
+    plt.plot(npa[:,0], npa[:, 1+vn.index('v')])
+
+The model is read with xppcall_numpy.OdeSystem, so the same subset of the ODE language is supported
+(no arrays, tables, markov, etc. in the model itself). All copies share the numerical options,
+and the integration step of adaptive methods is chosen for the ensemble as a whole.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import xppcall
+from xppcall_numpy import OdeSystem, token_re, names_in_expr
+
+
+# numbers per par/init line of the generated file, xpp does not like very long lines
+values_per_line = 8
+
+
+def copy_name(name):
+    """
+    return:
+    the name of an array of copies of a model name, v -> v_ (v_[j] is v_1, v_2, ... for xpp)
+    """
+    return name+'_'
+
+
+def to_copy(expr, per_copy):
+    """
+    expr - an expression of the ODE language
+    per_copy - the set of names that differ between copies
+
+    return:
+    the expression for the copy j of the ensemble, e.g. 'i-gna*v' -> 'i_[j]-gna*v_[j]'
+    """
+    def repl(so):
+        tok = so.group(0)
+        if tok in per_copy and not expr[so.end():].lstrip().startswith('('):
+            return copy_name(tok)+'[j]'
+        return tok
+    return token_re.sub(repl, expr)
+
+
+def value_lines(keyword, values):
+    """
+    keyword - 'par' or 'init'
+    values - the list of (name, value)
+
+    return:
+    the lines declaring the values, values_per_line values per line
+    """
+    return ['%s %s\n' % (keyword, ', '.join('%s=%r' % (name, float(v)) for name, v in values[k:k+values_per_line]))
+            for k in range(0, len(values), values_per_line)]
+
+
+def ensemble_srclines(srclines, runs):
+    """
+    srclines - an ODE-file content in the list of strings
+    runs - the list of dicts with the keys 'parameters' and 'inits' (optional), e.g. [{'parameters':{'i':1.0}}, ...]
+
+    return:
+    srclines of the ODE file with len(runs) copies of the model, the list of strings
+    """
+    sys_ = OdeSystem(srclines)
+    n = len(runs)
+    if n == 0:
+        raise ValueError('no runs for the ensemble')
+    runs = [{key:{k.lower():v for k,v in (run.get(key) or {}).items()} for key in ('parameters', 'inits')} for run in runs]
+
+    unknown = set(k for run in runs for k in run['parameters'] if k not in sys_.pars)
+    unknown |= set(k for run in runs for k in run['inits'] if k not in sys_.state_vars)
+    if unknown:
+        raise ValueError('not in the model: %s' % ', '.join(sorted(unknown)))
+
+    swept = [name for name in sys_.par_names if any(name in run['parameters'] for run in runs)]
+    per_copy = set(swept) | set(sys_.state_vars) | set(sys_.aux_vars)
+    # derived parameters and fixed quantities become arrays if they depend on anything that differs between copies
+    for name, expr in sys_.derived+sys_.fixed:
+        if names_in_expr(expr) & per_copy:
+            per_copy.add(name)
+    for name, args, expr in sys_.functions:
+        if (names_in_expr(expr)-set(args)) & per_copy:
+            raise ValueError('the function %s depends on a quantity that differs between copies' % name)
+
+    taken = set(sys_.par_names) | set(name for name, expr in sys_.derived+sys_.fixed) | per_copy
+    clash = [name for name in per_copy for j in range(1, n+1) if copy_name(name)+str(j) in taken]
+    if clash:
+        raise ValueError('names of the copies clash with names of the model: %s' % ', '.join(sorted(set(clash))))
+
+    ar = '[1..%d]' % n
+    lines = ['# ensemble of %d copies made by xppcall_ensemble\n' % n]
+    lines += value_lines('par', [(name, sys_.pars[name]) for name in sys_.par_names if name not in swept])
+    lines += value_lines('par', [(copy_name(name)+str(j+1), run['parameters'].get(name, sys_.pars[name]))
+                                 for name in swept for j, run in enumerate(runs)])
+    for name, args, expr in sys_.functions:
+        lines.append('%s(%s)=%s\n' % (name, ','.join(args), expr.strip()))
+    for name, expr in sys_.derived:
+        if name in per_copy:
+            lines.append('%s%s=%s\n' % (copy_name(name), ar, to_copy(expr, per_copy).strip()))
+        else:
+            lines.append('!%s=%s\n' % (name, expr.strip()))
+    for name, expr in sys_.fixed:
+        if name in per_copy:
+            lines.append('%s%s=%s\n' % (copy_name(name), ar, to_copy(expr, per_copy).strip()))
+        else:
+            lines.append('%s=%s\n' % (name, expr.strip()))
+    for name in sys_.state_vars:
+        lines.append("%s%s'=%s\n" % (copy_name(name), ar, to_copy(sys_.odes[name], per_copy).strip()))
+    for name in sys_.aux_vars:
+        lines.append('aux %s%s=%s\n' % (copy_name(name), ar, to_copy(sys_.aux[name], per_copy).strip()))
+    lines += value_lines('init', [(copy_name(name)+str(j+1), run['inits'].get(name, sys_.inits[name]))
+                                  for name in sys_.state_vars for j, run in enumerate(runs)])
+    # numerical options of the file, those of the run are given to xpp with -with
+    lines += ['@ %s=%s\n' % (k, v) for k, v in sorted(xppcall.read_numerics_settings(srclines).items())]
+    lines.append('done\n')
+    return lines
+
+
+def split_output(out, n, nstate, naux):
+    """
+    out - the output of the ensemble: time, then the copies of every state variable, then the copies of every aux variable
+    n - the number of copies
+
+    return:
+    the list of n arrays of shape (time points, 1+nstate+naux), columns as in the output of the model
+    """
+    cols = [[0]+[1+s*n+j for s in range(nstate)]+[1+nstate*n+a*n+j for a in range(naux)] for j in range(n)]
+    return [np.ascontiguousarray(out[:, c]) for c in cols]
+
+
+def xpprun_ensemble(filepath, runs, parameters=None, inits=None, variables=None, tmpdir=None, clean_after=False, reducers=None, **kwargs):
+    """
+    Runs all runs of the model in one xppaut process.
+
+    filepath - path to ode file
+    runs - the list of dicts, e.g. [{'parameters':{'i':1.0}, 'inits':{'v':-60}}, ...].
+           Only 'parameters' and 'inits' are taken into account.
+    parameters, inits - the dicts common to all runs, values of runs override them
+    variables - the list of names of variables to return, all variables if None
+    tmpdir - the folder where the scratch directory of the ensemble ODE file is created,
+             the temporary folder of the system (tempfile.gettempdir()) by default
+    clean_after - if True the ensemble ODE file and the scratch directory of the run are deleted after computations
+    reducers - the dict of xppcall.Reducer, as in xpprun. The summaries of every run are returned instead of Result.
+    **kwargs - keyword arguments of xpprun (xppname, numerics, every, t_from, dtype, cache, stats)
+
+    Output: the list of Result (out, vn) (or dicts of summaries) for every run, or None if xppaut has failed
+    """
+    if kwargs.get('backend', 'xpp') != 'xpp':
+        raise ValueError("the ensemble mode runs xppaut, backend should be 'xpp'")
+    merged = []
+    for run in runs:
+        kw = {'parameters': dict(parameters or {}), 'inits': dict(inits or {})}
+        kw['parameters'].update(run.get('parameters') or {})
+        kw['inits'].update(run.get('inits') or {})
+        merged.append(kw)
+
+    model = xppcall.load_model(filepath)
+    srclines = ensemble_srclines(model.srclines, merged)
+    sys_ = OdeSystem(model.srclines)
+
+    name, ext = os.path.splitext(os.path.basename(filepath))
+    workdir = tempfile.mkdtemp(prefix=name+'_ensemble_', dir=tmpdir)
+    ensemblefilepath = os.path.join(workdir, name+'_ensemble'+ext)
+    with open(ensemblefilepath, 'w') as f:
+        f.write(''.join(srclines))
+    try:
+        res = xppcall.xpprun(ensemblefilepath, tmpdir=workdir, clean_after=clean_after, **kwargs)
+    finally:
+        # the ensemble file is used once, it should not stay in the cache of models
+        with xppcall.model_cache_lock:
+            xppcall.model_cache.pop(os.path.abspath(ensemblefilepath), None)
+        if clean_after:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if not isinstance(res, xppcall.Result):
+        return res
+
+    vn = list(sys_.variables)
+    outs = split_output(res.out, len(merged), len(sys_.state_vars), len(sys_.aux_vars))
+    if variables is not None:
+        variables = [v.lower() for v in variables]
+        cols = [0]+[1+vn.index(v) for v in variables]
+        outs = [np.ascontiguousarray(out[:, cols]) for out in outs]
+        vn = variables
+    results = [xppcall.Result(out, list(vn)) for out in outs]
+    if reducers is not None:
+        return [xppcall.reduce_chunks(reducers, [res]) for res in results]
+    return results
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+
+# (ɔ) Py_XPPCALL - a python binding to amazing XPPAUT
+#
+#     Copyright 2015 Ilya Prokin
+#     https://sites.google.com/site/ilyaprokin/
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+NumPy backend of xpprun: xpprun('hh.ode', backend='numpy').
+
+A subset of the ODE language is translated to python functions that compute
+the right-hand side for many parameter sets at once, and the model is integrated
+in-process without xppaut and without files.
+
+Supported lines:
+dX/dt=..., X'=..., X(0)=..., init, par (p, param, number), !derived parameters,
+fixed quantities X=..., functions f(x,y)=..., aux, @ numerics, done.
+Arrays, tables, special, markov, wiener, etc. are not supported, ValueError is raised for them.
+Integration methods: euler, modeuler, rungekutta (default). Other methods are integrated with rungekutta.
+"""
+
+import re
+import threading
+import warnings
+import numpy as np
+
+import xppcall
+
+
+# numerical options of xpp and their default values
+default_numerics = {'dt': .05, 'total': 20., 't0': 0., 'njmp': 1, 'trans': 0., 'meth': 'rungekutta'}
+
+# functions of xpp and their numpy counterparts
+xpp_functions = {'exp': np.exp, 'ln': np.log, 'log': np.log, 'log10': np.log10, 'sqrt': np.sqrt,
+                 'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'asin': np.arcsin, 'acos': np.arccos,
+                 'atan': np.arctan, 'atan2': np.arctan2, 'sinh': np.sinh, 'cosh': np.cosh, 'tanh': np.tanh,
+                 'abs': np.abs, 'sign': np.sign, 'max': np.maximum, 'min': np.minimum, 'mod': np.mod,
+                 'flr': np.floor, 'ceil': np.ceil, 'heav': lambda x: np.where(x < 0, 0., 1.)}
+xpp_constants = {'pi': np.pi}
+
+name_re = '[a-z_][a-z0-9_]*'
+pair_re = re.compile('(%s) *= *([^, \t]+)' % name_re)
+par_line_re = re.compile('^(parameters|parameter|params|param|par|p|number|num)[ \t]+(.*)$')
+unsupported_re = re.compile('^(table|special|markov|wiener|global|volterra|bdry|set|options|export|only|#include|solv|vector|0=)\\b')
+# numbers go first, otherwise 'e' of '1e-5' would be taken for a name
+token_re = re.compile('(?:[0-9]+\\.?[0-9]*|\\.[0-9]+)(?:e[-+]?[0-9]+)?|%s' % name_re)
+
+
+class OdeSystem(object):
+    """
+    Equations of an ODE file in the subset of the ODE language supported by the NumPy backend.
+
+    Attributes:
+
+    state_vars, aux_vars, variables - names of variables as in xppcall.OdeModel
+    par_names - names of parameters, pars - the dict of their default values
+    inits - the dict of initial conditions (0 if not given)
+    numerics - the dict of numerical options, defaults of xpp are used for missing ones
+    odes, aux - the dicts {name: expression}
+    derived - the list of (name, expression) of !derived parameters
+    fixed - the list of (name, expression) of fixed quantities
+    functions - the list of (name, arguments, expression) of user functions
+    """
+
+    def __init__(self, srclines):
+        self.state_vars=[]; self.aux_vars=[]; self.par_names=[]
+        self.pars={}; self.inits={}; self.numerics=dict(default_numerics)
+        self.odes={}; self.aux={}; self.derived=[]; self.fixed=[]; self.functions=[]
+
+        for line in join_continued_lines(srclines):
+            if self.parse_line(line) == 'done':
+                break
+
+        self.variables = self.state_vars+self.aux_vars
+        for name in self.state_vars:
+            self.inits.setdefault(name, 0.)
+        self.inits = {k:v for k,v in self.inits.items() if k in self.odes}
+        self.fixed = sort_by_dependencies(self.fixed)
+
+    def parse_line(self, line):
+        """
+        adds the content of a line to the system, returns 'done' at the end of the file
+        """
+        line = line.split('#', 1)[0].strip().lower()
+        if line == '':
+            return
+        if line in ('d', 'done'):
+            return 'done'
+        if line.startswith('%') or '[' in line or unsupported_re.search(line) is not None:
+            raise ValueError('not supported by the numpy backend: %s' % line)
+
+        so = par_line_re.search(line)
+        if so is not None:
+            for name, value in pair_re.findall(so.group(2)):
+                if name not in self.pars:
+                    self.par_names.append(name)
+                self.pars[name] = float(value)
+            return
+        if line.startswith('@'):
+            self.numerics.update(pair_re.findall(line[1:]))
+            return
+        so = re.search('^init[ \t]+(.*)$', line)
+        if so is not None:
+            self.inits.update((name, float(value)) for name, value in pair_re.findall(so.group(1)))
+            return
+        so = re.search('^aux[ \t]+(%s) *=(.*)$' % name_re, line)
+        if so is not None:
+            self.aux_vars.append(so.group(1))
+            self.aux[so.group(1)] = so.group(2)
+            return
+        so = re.search('^! *(%s) *=(.*)$' % name_re, line)
+        if so is not None:
+            self.derived.append((so.group(1), so.group(2)))
+            return
+        so = re.search('^d(%s)/dt *=(.*)$|^(%s)\' *=(.*)$' % (name_re, name_re), line)
+        if so is not None:
+            name, expr = (so.group(1), so.group(2)) if so.group(1) is not None else (so.group(3), so.group(4))
+            self.state_vars.append(name)
+            self.odes[name] = expr
+            return
+        so = re.search('^(%s) *\\( *0 *\\) *= *([^ ]+)$' % name_re, line)
+        if so is not None:
+            self.inits[so.group(1)] = float(so.group(2))
+            return
+        so = re.search('^(%s) *\\(([a-z0-9_, ]*)\\) *=(.*)$' % name_re, line)
+        if so is not None:
+            args = [a.strip() for a in so.group(2).split(',')]
+            self.functions.append((so.group(1), args, so.group(3)))
+            return
+        so = re.search('^(%s) *=(.*)$' % name_re, line)
+        if so is not None:
+            self.fixed.append((so.group(1), so.group(2)))
+            return
+        raise ValueError('not supported by the numpy backend: %s' % line)
+
+    def float_numerics(self, numerics=None):
+        """
+        numerics - the dict of numerical options overriding those of the file
+
+        return:
+        dt, total, t0, njmp, trans, meth
+        """
+        num = dict(self.numerics)
+        if numerics is not None:
+            num.update((k.lower(), v) for k, v in numerics.items())
+        if 'nout' in num and 'njmp' not in (numerics or {}):
+            num['njmp'] = num['nout']
+        return (float(num['dt']), float(num['total']), float(num['t0']), int(float(num['njmp'])),
+                float(num['trans']), str(num['meth']))
+
+
+def join_continued_lines(srclines):
+    """
+    return:
+    the lines of an ODE file where lines ending with '\\' are joined with the next ones
+    """
+    lines = []; prev = ''
+    for line in srclines:
+        line = line.rstrip('\r\n')
+        if line.rstrip().endswith('\\'):
+            prev += line.rstrip()[:-1]
+        else:
+            lines.append(prev+line)
+            prev = ''
+    if prev != '':
+        lines.append(prev)
+    return lines
+
+
+def names_in_expr(expr):
+    return set(t for t in token_re.findall(expr) if not t[0].isdigit() and t[0] != '.')
+
+
+def sort_by_dependencies(fixed):
+    """
+    fixed - the list of (name, expression)
+
+    return:
+    the list ordered so that every quantity is computed after those it depends on
+    """
+    pending = list(fixed)
+    names = set(name for name, expr in fixed)
+    done = set(); ordered = []
+    while pending:
+        ready = [(name, expr) for name, expr in pending if (names_in_expr(expr) & names) <= done | set([name])]
+        if not ready:
+            raise ValueError('circular definition of fixed quantities: %s' % ', '.join(name for name, expr in pending))
+        for item in ready:
+            ordered.append(item)
+            done.add(item[0])
+            pending.remove(item)
+    return ordered
+
+
+def translate(expr, known, functions):
+    """
+    expr - an expression of the ODE language
+    known - the set of names of variables that may appear in expr
+    functions - the set of names of user functions
+
+    return:
+    python expression, names of the model get the prefix 'v_', functions of xpp the prefix 'f_'
+    """
+    def repl(so):
+        tok = so.group(0)
+        if tok[0].isdigit() or tok[0] == '.':
+            return tok
+        is_call = expr[so.end():].lstrip().startswith('(')
+        if is_call and tok in functions:
+            return 'v_'+tok
+        if is_call and tok in xpp_functions:
+            return 'f_'+tok
+        if not is_call and tok in known:
+            return 'v_'+tok
+        if not is_call and tok in xpp_constants:
+            return 'f_'+tok
+        raise ValueError('unknown name %s in %s' % (tok, expr))
+    return token_re.sub(repl, expr).replace('^', '**')
+
+
+class NumpyModel(object):
+    """
+    An ODE file compiled to python functions.
+
+    Ex.: integrate hh.ode for 1000 input currents at once
+    nm = NumpyModel(xppcall.file_to_lines('hh.ode'))
+    out = nm.integrate(parameters={'i':np.linspace(0, 20, 1000)}) # out.shape == (1000, 401, 5)
+    """
+
+    def __init__(self, srclines):
+        self.system = sys_ = OdeSystem(srclines)
+        self.variables = sys_.variables
+
+        pars = set(sys_.par_names)
+        derived = set(name for name, expr in sys_.derived)
+        fixed = set(name for name, expr in sys_.fixed)
+        functions = set(name for name, args, expr in sys_.functions)
+        known = set(sys_.state_vars) | pars | derived | fixed | set(['t'])
+
+        prelude = ['    v_%s = y[%d]' % (name, i) for i, name in enumerate(sys_.state_vars)]
+        prelude += ['    v_%s = p[%d]' % (name, i) for i, name in enumerate(sys_.par_names)]
+        prelude += ['    v_%s = %s' % (name, translate(expr, known, functions)) for name, expr in sys_.derived]
+        for name, args, expr in sys_.functions:
+            prelude += ['    def v_%s(%s):' % (name, ', '.join('v_'+a for a in args)),
+                        '        return %s' % translate(expr, known | set(args), functions)]
+        prelude += ['    v_%s = %s' % (name, translate(expr, known, functions)) for name, expr in sys_.fixed]
+
+        src = ['def rhs(v_t, y, p, dy):'] + prelude
+        src += ['    dy[%d] = %s' % (i, translate(sys_.odes[name], known, functions)) for i, name in enumerate(sys_.state_vars)]
+        src += ['', 'def aux(v_t, y, p):'] + prelude
+        src += ['    return [%s]' % ', '.join(translate(sys_.aux[name], known, functions) for name in sys_.aux_vars)]
+        self.source = '\n'.join(src)+'\n'
+
+        namespace = dict(('f_'+k, v) for k, v in xpp_functions.items())
+        namespace.update(('f_'+k, v) for k, v in xpp_constants.items())
+        try:
+            exec(compile(self.source, '<%s>' % self.__class__.__name__, 'exec'), namespace)
+        except SyntaxError as e:
+            raise ValueError('cannot translate the model to python: %s' % e)
+        self.rhs = namespace['rhs']
+        self.aux = namespace['aux']
+
+    def integrate(self, parameters=None, inits=None, numerics=None, dtype=np.float64):
+        """
+        parameters - the dict of parameters, a value is a number or a 1-D array of values for a batch of runs
+        inits - the dict of initial conditions, a value is a number or a 1-D array
+        numerics - the dict of numerical options (dt, total, t0, njmp, trans, meth) overriding those of the file
+
+        return:
+        numpy.array out of shape (number of time points, 1+len(variables)) as in xpprun,
+        or (batch size, number of time points, 1+len(variables)) if any of values is an array
+        """
+        sys_ = self.system
+        parameters = {k.lower():v for k,v in (parameters or {}).items()}
+        inits = {k.lower():v for k,v in (inits or {}).items()}
+
+        values = [parameters.get(name, sys_.pars[name]) for name in sys_.par_names]
+        values += [inits.get(name, sys_.inits[name]) for name in sys_.state_vars]
+        batched = any(np.ndim(v) > 0 for v in values)
+        nbatch = max([np.size(v) for v in values] + [1])
+        p = np.empty((len(sys_.par_names), nbatch))
+        y = np.empty((len(sys_.state_vars), nbatch))
+        for i, name in enumerate(sys_.par_names):
+            p[i] = parameters.get(name, sys_.pars[name])
+        for i, name in enumerate(sys_.state_vars):
+            y[i] = inits.get(name, sys_.inits[name])
+
+        dt, total, t0, njmp, trans, meth = sys_.float_numerics(numerics)
+        step = stepper(meth)
+        nsteps = int(round(total/dt))
+        keep = [k for k in range(0, nsteps+1, njmp) if t0+k*dt >= trans-1e-12*abs(dt)]
+
+        t = np.array([t0+k*dt for k in keep])
+        ys = np.empty((len(keep), len(sys_.state_vars), nbatch))
+        work = [np.empty_like(y) for i in range(5)]
+        j = 0
+        for k in range(nsteps+1):
+            if j < len(keep) and keep[j] == k:
+                ys[j] = y
+                j += 1
+            if j == len(keep):
+                break
+            y = step(self.rhs, t0+k*dt, y, p, dt, work)
+
+        out = np.empty((nbatch, len(t), 1+len(self.variables)), dtype=dtype)
+        out[:, :, 0] = t
+        out[:, :, 1:1+len(sys_.state_vars)] = ys.transpose(2, 0, 1)
+        if sys_.aux_vars:
+            yt = ys.transpose(1, 0, 2) # (variables, time, batch)
+            for i, a in enumerate(self.aux(t[:, None], yt, p[:, None, :])):
+                out[:, :, 1+len(sys_.state_vars)+i] = np.transpose(np.broadcast_to(a, (len(t), nbatch)))
+        return out if batched else out[0]
+
+
+def euler(rhs, t, y, p, dt, work):
+    k1 = work[0]
+    rhs(t, y, p, k1)
+    return y+dt*k1
+
+def modeuler(rhs, t, y, p, dt, work):
+    k1, k2 = work[0], work[1]
+    rhs(t, y, p, k1)
+    rhs(t+dt, y+dt*k1, p, k2)
+    return y+.5*dt*(k1+k2)
+
+def rungekutta(rhs, t, y, p, dt, work):
+    k1, k2, k3, k4 = work[0], work[1], work[2], work[3]
+    rhs(t, y, p, k1)
+    rhs(t+.5*dt, y+.5*dt*k1, p, k2)
+    rhs(t+.5*dt, y+.5*dt*k2, p, k3)
+    rhs(t+dt, y+dt*k3, p, k4)
+    return y+dt/6.*(k1+2*k2+2*k3+k4)
+
+def stepper(meth):
+    """
+    meth - the name of integration method of xpp, it can be abbreviated as in xpp
+
+    return:
+    the function making one step
+    """
+    meth = meth.lower()
+    for name, step in (('euler', euler), ('modeuler', modeuler), ('rungekutta', rungekutta), ('runge-kutta', rungekutta)):
+        if name.startswith(meth):
+            return step
+    warnings.warn('meth=%s is not available in the numpy backend, rungekutta is used' % meth)
+    return rungekutta
+
+
+# compiled models, {absolute path: (OdeModel, NumpyModel)}
+compiled = {}
+compiled_lock = threading.Lock()
+
+def load_numpy_model(filepath):
+    """
+    return:
+    NumpyModel of the file, compiled again only if xppcall.load_model has parsed the file again
+    """
+    model = xppcall.load_model(filepath)
+    with compiled_lock:
+        cached = compiled.get(model.filepath)
+    if cached is not None and cached[0] is model:
+        return cached[1]
+    nm = NumpyModel(model.srclines)
+    with compiled_lock:
+        compiled[model.filepath] = (model, nm)
+    return nm
+
+
+def xpprun_numpy(filepath, parameters=None, inits=None, numerics=None, dtype=np.float64, **kwargs):
+    """
+    xpprun(filepath, backend='numpy', ...) integrates the model with NumpyModel instead of xppaut.
+    Options of xpprun that only concern xppaut (version, xppname, postfix, clean_after, tmpdir) are ignored.
+
+    Output: tuple (out, vn) as in xpprun
+    """
+    nm = load_numpy_model(filepath)
+    return nm.integrate(parameters=parameters, inits=inits, numerics=numerics, dtype=dtype), list(nm.variables)
+
+
+def xpprun_batch_numpy(filepath, runs, numerics=None, dtype=np.float64, **kwargs):
+    """
+    xpprun_batch(filepath, runs, backend='numpy') integrates all runs at once as one batch.
+    Only 'parameters' and 'inits' of runs are taken into account, numerics (dict of xpp options) is common to all runs.
+
+    Output: generator of xppcall.Result for each run
+    """
+    runs = list(runs)
+    if not runs:
+        return
+    nm = load_numpy_model(filepath)
+    sys_ = nm.system
+    parameters = {}; inits = {}
+    for dst, key, defaults in ((parameters, 'parameters', sys_.pars), (inits, 'inits', sys_.inits)):
+        names = set(k.lower() for run in runs for k in (run.get(key) or {}) if k.lower() in defaults)
+        for name in names:
+            dst[name] = np.array([lower_keys(run.get(key)).get(name, defaults[name]) for run in runs], dtype=float)
+    out = nm.integrate(parameters=parameters, inits=inits, numerics=numerics, dtype=dtype)
+    if out.ndim == 2: # runs do not change anything
+        out = np.repeat(out[None], len(runs), axis=0)
+    for i in range(len(runs)):
+        yield xppcall.Result(out[i], list(nm.variables))
+
+
+def lower_keys(d):
+    return {k.lower():v for k,v in (d or {}).items()}
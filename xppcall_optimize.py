@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# (ɔ) Py_XPPCALL - a python binding to amazing XPPAUT
+#
+#     Copyright 2015 Ilya Prokin
+#     https://sites.google.com/site/ilyaprokin/
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Objective functions for population-based optimizers (scipy.optimize.differential_evolution etc.)
+that evaluate a whole population of parameter sets in one parallel batch of xppaut runs.
+
+Ex.: fit the input current of hh.ode to a target voltage trace
+from scipy.optimize import differential_evolution
+objective = PopulationObjective('hh.ode', ['i'], SquaredError('v', target_v), workers=8, clean_after=True, timeout=10)
+res = differential_evolution(objective, [(0, 40)], vectorized=True, updating='deferred')
+# or with the map of the objective: differential_evolution(objective, [(0, 40)], workers=objective.map, updating='deferred')
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from xppcall import evaluate_points
+
+
+class SquaredError(object):
+    """
+    The loss: mean squared difference between a variable and the target, np.mean((res[var]-target)**2).
+    A run with another number of time points than the target gets infinite loss.
+    """
+
+    def __init__(self, var, target):
+        self.var = var
+        self.target = np.asarray(target)
+
+    def __call__(self, res):
+        values = res[self.var]
+        if values.shape != self.target.shape:
+            return np.inf
+        return np.mean((values-self.target)**2)
+
+
+class PopulationObjective(object):
+    """
+    The objective function of parameters x for scipy optimizers.
+
+    objective(x) with x of shape (len(names),) returns the loss of one run,
+    objective(x) with x of shape (len(names), S) (scipy vectorized=True) returns the losses of S runs, run as one batch,
+    objective.map(func, points) can be given as workers= of differential_evolution.
+
+    Repeated points are taken from a cache instead of running xppaut again.
+    A failed run, a run longer than timeout, or a non-finite loss give penalty at once (no retries by default),
+    errors raised by the loss are not caught.
+
+    Input:
+
+    filepath - path to ode file
+    names - the list of names of parameters, the order of x
+    loss - a function of Result returning a number (e.g. SquaredError), or a Reducer of xppcall,
+           which is evaluated while the output is read
+    penalty - the loss of failed runs
+    cache_size - the number of points kept in the cache
+    **kwargs - keyword arguments of evaluate_points, xpprun_batch and xpprun (workers, pool, xppname, clean_after, timeout, ...).
+               parameters are the values of the parameters not in names, reducers cannot be given with a Reducer loss.
+
+    Attributes:
+
+    runs - the number of xppaut runs
+    cached - the number of points taken from the cache
+    failed - the number of runs that got penalty
+    """
+
+    def __init__(self, filepath, names, loss, penalty=1e10, cache_size=100000, **kwargs):
+        self.filepath = filepath
+        self.names = list(names)
+        self.loss = loss
+        self.penalty = penalty
+        self.cache_size = cache_size
+        self.kwargs = kwargs
+        self.cache = OrderedDict()
+        self.runs = self.cached = self.failed = 0
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 1:
+            return self.evaluate(x[None, :])[0]
+        return self.evaluate(x.T)
+
+    def map(self, func, iterable):
+        """
+        the map for differential_evolution(..., workers=objective.map): the points of a population are run as one batch
+        if func is this objective (as wrapped by scipy), otherwise func is mapped one by one
+        """
+        points = list(iterable)
+        if func is self or getattr(func, 'f', None) is self:
+            return list(self.evaluate(np.array(points, dtype=float)))
+        return [func(p) for p in points]
+
+    def evaluate(self, X):
+        """
+        X - numpy.array of points, one row per run
+
+        return:
+        numpy.array of losses
+        """
+        X = np.atleast_2d(X)
+        keys = [tuple(x.tolist()) for x in X]
+        losses = {}; todo = []
+        for key in keys:
+            if key in losses:
+                continue
+            if key in self.cache:
+                losses[key] = self.cache.pop(key)
+                self.cache[key] = losses[key] # the most recent one
+                self.cached += 1
+            else:
+                losses[key] = None
+                todo.append(key)
+
+        if todo:
+            for key, value in zip(todo, evaluate_points(self.filepath, self.names, todo, self.loss, **self.kwargs)):
+                losses[key] = self.run_loss(value)
+                self.store(key, losses[key])
+            self.runs += len(todo)
+        return np.array([losses[key] for key in keys])
+
+    def run_loss(self, value):
+        """
+        value - the loss of a run as returned by evaluate_points, None if the run has failed
+        """
+        if value is None or not np.isfinite(value):
+            self.failed += 1
+            return self.penalty
+        return float(value)
+
+    def store(self, key, value):
+        self.cache[key] = value
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
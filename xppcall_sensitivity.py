@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+# (ɔ) Py_XPPCALL - a python binding to amazing XPPAUT
+#
+#     Copyright 2015 Ilya Prokin
+#     https://sites.google.com/site/ilyaprokin/
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Sensitivity analysis of parameters of an ODE model: Morris elementary effects and Sobol indices.
+
+Sample points are generated in the unit hypercube and mapped to the ranges of parameters,
+identical points are run once, and all runs go through xpprun_batch in parallel.
+The output of a run is a number: a Reducer of xppcall (computed while the output is read)
+or a function of Result.
+
+Ex.:
+from xppcall import Max
+from xppcall_sensitivity import parameter_ranges, morris, sobol
+ranges = parameter_ranges('hh.ode', ['gna', 'gk', 'gl', 'i'], rel=.2)
+ranges['i'] = (0., 20.)
+print(morris('hh.ode', ranges, Max('v'), trajectories=20, clean_after=True))
+print(sobol('hh.ode', ranges, Max('v'), n=512, clean_after=True))
+
+Sobol sequences of scipy (scipy.stats.qmc) are used for Saltelli samples if scipy is installed,
+pseudo-random numbers otherwise.
+"""
+
+import numpy as np
+
+from xppcall import read_pars_values_from_file, evaluate_points
+
+try:
+    from scipy.stats import qmc
+except ImportError:
+    qmc = None
+
+
+def parameter_ranges(filepath, names=None, rel=.1):
+    """
+    filepath - path to ode file
+    names - the list of names of parameters, all parameters of the file if None
+    rel - the relative half-width of the ranges
+
+    return:
+    the dict {name: (low, high)} of ranges around the values in the file, (-rel, rel) for parameters equal to 0
+    """
+    pars = read_pars_values_from_file(filepath, names)
+    ranges = {}
+    for name, value in pars.items():
+        value = float(value)
+        if value == 0:
+            ranges[name] = (-rel, rel)
+        else:
+            ranges[name] = tuple(sorted((value*(1-rel), value*(1+rel))))
+    return ranges
+
+
+def morris_sample(k, trajectories=10, levels=4, seed=None):
+    """
+    Morris one-at-a-time design in the unit hypercube.
+
+    k - the number of parameters
+    trajectories - the number of trajectories, each of k+1 points
+    levels - the (even) number of levels of the grid, the step is levels/(2*(levels-1))
+
+    return:
+    numpy.array of shape (trajectories*(k+1), k)
+    """
+    if levels < 2 or levels % 2:
+        raise ValueError('levels should be an even number')
+    rng = np.random.RandomState(seed)
+    delta = levels/(2.*(levels-1))
+    X = np.empty((trajectories, k+1, k))
+    for r in range(trajectories):
+        x = rng.randint(0, levels, size=k)/(levels-1.)
+        X[r, 0] = x
+        for step, i in enumerate(rng.permutation(k)):
+            # the step goes up if it stays in the grid, down otherwise
+            x[i] = x[i]+delta if x[i]+delta <= 1+1e-12 else x[i]-delta
+            X[r, step+1] = x
+    return X.reshape(-1, k)
+
+
+def morris_indices(X, Y, k):
+    """
+    X - the Morris design made by morris_sample
+    Y - the outputs at its points (nan for failed runs)
+    k - the number of parameters
+
+    return:
+    mu, mu_star, sigma - numpy.arrays of the mean, the mean of absolute values and the standard deviation
+    of elementary effects of every parameter (in units of the ranges)
+    """
+    X = X.reshape(-1, k+1, k); Y = np.asarray(Y, dtype=float).reshape(-1, k+1)
+    effects = [[] for i in range(k)]
+    for x, y in zip(X, Y):
+        dx = np.diff(x, axis=0)
+        dy = np.diff(y)
+        for step in range(k):
+            i = np.argmax(np.abs(dx[step]))
+            if np.isfinite(dy[step]):
+                effects[i].append(dy[step]/dx[step, i])
+    mu = np.array([np.mean(e) if e else np.nan for e in effects])
+    mu_star = np.array([np.mean(np.abs(e)) if e else np.nan for e in effects])
+    sigma = np.array([np.std(e, ddof=1) if len(e) > 1 else np.nan for e in effects])
+    return mu, mu_star, sigma
+
+
+def saltelli_sample(k, n=256, seed=None):
+    """
+    Saltelli design in the unit hypercube: matrices A, B and A with the column i taken from B, for every i.
+    A and B are shared by the indices of all parameters.
+
+    k - the number of parameters
+    n - the number of base points (a power of 2 for Sobol sequences)
+
+    return:
+    numpy.array of shape (n*(k+2), k): A, B, AB_1, ..., AB_k
+    """
+    if qmc is not None:
+        base = qmc.Sobol(2*k, scramble=True, seed=seed).random(n)
+    else:
+        base = np.random.RandomState(seed).random_sample((n, 2*k))
+    A, B = base[:, :k], base[:, k:]
+    blocks = [A, B]
+    for i in range(k):
+        AB = A.copy()
+        AB[:, i] = B[:, i]
+        blocks.append(AB)
+    return np.vstack(blocks)
+
+
+def sobol_indices(Y, n, k):
+    """
+    Y - the outputs at the points of saltelli_sample (nan for failed runs)
+    n, k - as in saltelli_sample
+
+    return:
+    S1, ST - numpy.arrays of the first order and total Sobol indices of every parameter
+    (the estimators of Saltelli 2010 and Jansen 1999)
+    """
+    Y = np.asarray(Y, dtype=float).reshape(k+2, n)
+    fA, fB = Y[0], Y[1]
+    S1 = np.empty(k); ST = np.empty(k)
+    for i in range(k):
+        fAB = Y[2+i]
+        ok = np.isfinite(fA) & np.isfinite(fB) & np.isfinite(fAB)
+        f = np.concatenate([fA[ok], fB[ok]])
+        var = np.var(f)
+        if ok.sum() < 2 or var == 0:
+            S1[i] = ST[i] = np.nan
+            continue
+        # centering f does not change the estimate on average but lowers its variance
+        S1[i] = np.mean((fB[ok]-f.mean())*(fAB[ok]-fA[ok]))/var
+        ST[i] = .5*np.mean((fA[ok]-fAB[ok])**2)/var
+    return S1, ST
+
+
+def evaluate(filepath, ranges, names, X, output, **kwargs):
+    """
+    Runs the model at the points of a design, identical points are run once.
+
+    filepath - path to ode file
+    ranges - the dict {name: (low, high)}
+    names - the list of names of parameters, the order of columns of X
+    X - numpy.array of points in the unit hypercube, one row per run
+    output - Reducer (e.g. xppcall.Max('v')) or a function of Result returning a number
+    **kwargs - keyword arguments of evaluate_points, xpprun_batch and xpprun (workers, pool, xppname, clean_after, ...)
+
+    return:
+    numpy.array of outputs, nan for failed runs
+    """
+    lo = np.array([ranges[name][0] for name in names], dtype=float)
+    hi = np.array([ranges[name][1] for name in names], dtype=float)
+    P = lo+np.asarray(X)*(hi-lo)
+    unique, inverse = np.unique(P, axis=0, return_inverse=True)
+    inverse = np.ravel(inverse)
+
+    values = evaluate_points(filepath, names, unique.tolist(), output, **kwargs)
+    Yu = np.array([np.nan if y is None else y for y in values], dtype=float)
+    return Yu[inverse]
+
+
+def morris(filepath, ranges, output, trajectories=10, levels=4, seed=None, **kwargs):
+    """
+    Morris screening of parameters.
+
+    filepath - path to ode file
+    ranges - the dict {name: (low, high)}, see parameter_ranges
+    output - Reducer or a function of Result returning a number
+    trajectories, levels, seed - see morris_sample
+    **kwargs - keyword arguments of xpprun_batch and xpprun
+
+    return:
+    the dict {name: {'mu':..., 'mu_star':..., 'sigma':...}} of statistics of elementary effects,
+    mu_star ranks the importance of parameters, sigma tells nonlinearity and interactions
+    """
+    names = sorted(ranges)
+    X = morris_sample(len(names), trajectories, levels, seed)
+    Y = evaluate(filepath, ranges, names, X, output, **kwargs)
+    mu, mu_star, sigma = morris_indices(X, Y, len(names))
+    return {name: {'mu': mu[i], 'mu_star': mu_star[i], 'sigma': sigma[i]} for i, name in enumerate(names)}
+
+
+def sobol(filepath, ranges, output, n=256, seed=None, **kwargs):
+    """
+    Sobol indices of parameters, n*(len(ranges)+2) runs.
+
+    filepath - path to ode file
+    ranges - the dict {name: (low, high)}, see parameter_ranges
+    output - Reducer or a function of Result returning a number
+    n, seed - see saltelli_sample
+    **kwargs - keyword arguments of xpprun_batch and xpprun
+
+    return:
+    the dict {name: {'S1':..., 'ST':...}} of the first order and total indices
+    """
+    names = sorted(ranges)
+    X = saltelli_sample(len(names), n, seed)
+    Y = evaluate(filepath, ranges, names, X, output, **kwargs)
+    S1, ST = sobol_indices(Y, n, len(names))
+    return {name: {'S1': S1[i], 'ST': ST[i]} for i, name in enumerate(names)}
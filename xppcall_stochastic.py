@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+# (ɔ) Py_XPPCALL - a python binding to amazing XPPAUT
+#
+#     Copyright 2015 Ilya Prokin
+#     https://sites.google.com/site/ilyaprokin/
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Replicates of stochastic models (models using ran(), normal(), wiener etc. of xpp).
+
+Every replicate is an xppaut run with its own seed of the random number generator (the option seed of xpp),
+replicates run in parallel with xpprun_batch, and the statistics of the trajectories are accumulated
+as the runs come back: the mean and the variance (Welford's algorithm) and quantiles (the P-square algorithm),
+so the memory does not depend on the number of replicates.
+
+Ex.:
+stats = xpprun_replicates('noisy.ode', 10000, seed=1, quantiles=(.05, .5, .95), clean_after=True)
+plt.plot(stats.t, stats['v'])                              # mean of v over replicates
+plt.fill_between(stats.t, stats.quantile('v', .05), stats.quantile('v', .95))
+"""
+
+import multiprocessing
+
+import numpy as np
+
+from xppcall import xpprun_batch, Result
+
+
+class Welford(object):
+    """
+    The running mean and variance of arrays of the same shape (Welford's algorithm)
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        self.n += 1
+        if self.mean is None:
+            self.mean = x.copy()
+            self.m2 = np.zeros_like(x)
+        else:
+            delta = x-self.mean
+            self.mean += delta/self.n
+            self.m2 += delta*(x-self.mean)
+
+    @property
+    def var(self):
+        """
+        the sample variance, nan for less than two arrays
+        """
+        if self.n < 2:
+            return None if self.mean is None else np.full_like(self.mean, np.nan)
+        return self.m2/(self.n-1)
+
+    @property
+    def std(self):
+        var = self.var
+        return None if var is None else np.sqrt(var)
+
+
+class P2Quantile(object):
+    """
+    The running estimate of the quantile p of every element of arrays of the same shape,
+    the P-square algorithm of Jain and Chlamtac (1985): five markers per element, no values are kept.
+    The quantile is exact for less than five arrays.
+    """
+
+    def __init__(self, p):
+        if not 0 < p < 1:
+            raise ValueError('the quantile should be between 0 and 1')
+        self.p = p
+        self.n = 0
+        self.first = []
+        self.dinc = np.array([0., p/2, p, (1+p)/2, 1.])
+
+    def add(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        self.n += 1
+        if self.n <= 5:
+            self.first.append(x.copy())
+            if self.n == 5:
+                self.q = np.sort(np.array(self.first), axis=0)
+                shape = (5,)+(1,)*x.ndim
+                self.pos = np.broadcast_to(np.arange(1., 6.).reshape(shape), self.q.shape).copy()
+                self.desired = np.array([1., 1+2*self.p, 1+4*self.p, 3+2*self.p, 5.]).reshape(shape)
+                self.first = []
+            return
+
+        q = self.q; pos = self.pos
+        np.minimum(q[0], x, out=q[0])
+        np.maximum(q[4], x, out=q[4])
+        # markers above x move one position up
+        for i in (1, 2, 3):
+            pos[i] += x < q[i]
+        pos[4] += 1
+        self.desired = self.desired+self.dinc.reshape(self.desired.shape)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in (1, 2, 3):
+                d = self.desired[i]-pos[i]
+                up = (d >= 1) & (pos[i+1]-pos[i] > 1)
+                down = (d <= -1) & (pos[i-1]-pos[i] < -1)
+                move = up | down
+                if not move.any():
+                    continue
+                s = np.where(up, 1., -1.)
+                # parabolic prediction, linear one if it is not between the neighbours
+                qp = q[i]+s/(pos[i+1]-pos[i-1])*((pos[i]-pos[i-1]+s)*(q[i+1]-q[i])/(pos[i+1]-pos[i])
+                                                + (pos[i+1]-pos[i]-s)*(q[i]-q[i-1])/(pos[i]-pos[i-1]))
+                qn = np.where(up, q[i+1], q[i-1]); pn = np.where(up, pos[i+1], pos[i-1])
+                ql = q[i]+s*(qn-q[i])/(pn-pos[i])
+                qnew = np.where((q[i-1] < qp) & (qp < q[i+1]), qp, ql)
+                q[i] = np.where(move, qnew, q[i])
+                pos[i] += np.where(move, s, 0.)
+
+    @property
+    def value(self):
+        if self.n == 0:
+            return None
+        if self.n < 5:
+            return np.percentile(np.array(self.first), 100*self.p, axis=0)
+        if self.n == 5:
+            return np.percentile(self.q, 100*self.p, axis=0)
+        return self.q[2].copy()
+
+
+class ReplicateStats(object):
+    """
+    Statistics of the trajectories of replicates, made by xpprun_replicates.
+
+    Attributes:
+
+    t - time points
+    vn - the list of names of variables
+    n - the number of replicates accumulated, failed - the number of failed ones
+    mean, var, std - numpy.arrays of shape (time points, variables)
+    quantiles - the dict {p: numpy.array of shape (time points, variables)}
+    seeds - the list of seeds of the replicates, in the order of runs
+    """
+
+    def __init__(self, quantiles=(), seeds=()):
+        self.t = None
+        self.vn = None
+        self.welford = Welford()
+        self.sketches = {p: P2Quantile(p) for p in quantiles}
+        self.failed = 0
+        self.seeds = list(seeds)
+
+    def add(self, res):
+        """
+        res - Result of a replicate. A failed run (not Result) or a run of another length counts as failed.
+        """
+        if not isinstance(res, Result):
+            self.failed += 1
+            return
+        out = res.out
+        if self.t is None:
+            self.t = out[:, 0].copy()
+            self.vn = list(res.vn)
+        elif out.shape[0] != len(self.t):
+            self.failed += 1
+            return
+        values = out[:, 1:]
+        self.welford.add(values)
+        for sketch in self.sketches.values():
+            sketch.add(values)
+
+    @property
+    def n(self):
+        return self.welford.n
+
+    @property
+    def mean(self):
+        return self.welford.mean
+
+    @property
+    def var(self):
+        return self.welford.var
+
+    @property
+    def std(self):
+        return self.welford.std
+
+    @property
+    def quantiles(self):
+        return {p: sketch.value for p, sketch in self.sketches.items()}
+
+    def __getitem__(self, name):
+        """
+        the mean of the variable name over replicates
+        """
+        return self.mean[:, self.vn.index(name.lower())]
+
+    def quantile(self, name, p):
+        return self.sketches[p].value[:, self.vn.index(name.lower())]
+
+    def __repr__(self):
+        return '<ReplicateStats %d replicates (failed %d), variables %s>' % (self.n, self.failed, ', '.join((self.vn or [])[:10]))
+
+
+def replicate_seeds(replicates, seed=0):
+    """
+    return:
+    the list of seeds of replicates: seed+1, ..., seed+replicates, the same for the same seed
+    """
+    return [seed+1+i for i in range(replicates)]
+
+
+def xpprun_replicates(filepath, replicates, seed=0, quantiles=(), numerics=None, window=None, **kwargs):
+    """
+    Runs replicates of a stochastic model with different seeds and accumulates the statistics of their trajectories.
+
+    filepath - path to ode file
+    replicates - the number of replicates
+    seed - the seeds of the replicates are seed+1, ..., seed+replicates (replicate_seeds), given to xpp as the option seed
+    quantiles - the quantiles to estimate, e.g. (.05, .5, .95)
+    numerics - the dict of numerical options common to all replicates
+    window - the size of the reorder buffer, 4*workers by default.
+             Results are added in the order of seeds, so the results that finish before a slow replicate
+             are kept until it is done. A replicate is started only within window seeds of the first one
+             not added yet (ahead of xpprun_batch), so at most window trajectories are held in memory.
+             A replicate that hangs stops the start of new ones once the window is full, give timeout= to kill it.
+    **kwargs - keyword arguments of xpprun_batch and xpprun (workers, pool, xppname, parameters, variables, clean_after, ...)
+
+    Output: ReplicateStats. Only the statistics are kept, the trajectories are dropped as soon as they are added.
+    """
+    seeds = replicate_seeds(replicates, seed)
+    runs = []
+    for s in seeds:
+        num = dict(numerics or {})
+        num['seed'] = s
+        runs.append({'numerics': num})
+    stats = ReplicateStats(quantiles, seeds)
+    if window is None:
+        window = 4*(kwargs.get('workers') or multiprocessing.cpu_count())
+    # in the order of seeds, so that the quantile estimates are reproducible
+    pending = {}
+    first = 0
+    for i, res in xpprun_batch(filepath, runs, ordered=False, ahead=window, **kwargs):
+        pending[i] = res
+        while first in pending:
+            stats.add(pending.pop(first))
+            first += 1
+    return stats